@@ -1,21 +1,160 @@
-from flask import Flask, app
+import os
+import threading
+from flask import Flask
 from flask_mongoengine import MongoEngine
 from flask_login import LoginManager
+from flask_wtf.csrf import CSRFProtect
+from mongoengine.connection import get_connection
+from pymongo import ReadPreference
 
-def create_app():
+# extensions are created unbound so models can be declared against them; create_app binds
+# them to an app. importing the package does not connect to anything
+db = MongoEngine()
+login_manager = LoginManager()
+login_manager.login_view = 'main.login'  # Redirect to login page if unauthenticated or unauthorized
+# every POST (forms and the loan buttons) must carry the session's CSRF token
+csrf = CSRFProtect()
+
+def mongo_client_options(config):
+    #MongoClient/AsyncMongoClient keyword arguments from the MONGODB_* settings
+    return {
+        'minPoolSize': config['MONGODB_MIN_POOL_SIZE'],
+        'maxPoolSize': config['MONGODB_MAX_POOL_SIZE'],
+        'connectTimeoutMS': config['MONGODB_CONNECT_TIMEOUT_MS'],
+        'serverSelectionTimeoutMS': config['MONGODB_SERVER_SELECTION_TIMEOUT_MS'],
+        'socketTimeoutMS': config['MONGODB_SOCKET_TIMEOUT_MS'],
+        'waitQueueTimeoutMS': config['MONGODB_WAIT_QUEUE_TIMEOUT_MS'],
+    }
+
+
+def read_preference(mode):
+    #'secondaryPreferred' -> ReadPreference.SECONDARY_PREFERRED
+    modes = {preference.mongos_mode: preference for preference in (
+        ReadPreference.PRIMARY, ReadPreference.PRIMARY_PREFERRED, ReadPreference.SECONDARY,
+        ReadPreference.SECONDARY_PREFERRED, ReadPreference.NEAREST,
+    )}
+    if mode not in modes:
+        raise ValueError(f"unknown read preference {mode!r}, expected one of {', '.join(modes)}")
+    return modes[mode]
+
+
+def warm_up_connections(app):
+    #connects the worker's client while it boots: the ping does server discovery and opens
+    #the first connection, pymongo then fills the pool up to MONGODB_MIN_POOL_SIZE. runs in
+    #the background so neither startup nor flask commands wait on it. call it after the
+    #fork when the app is preloaded in a master process
+    def ping():
+        try:
+            get_connection().admin.command('ping')
+        except Exception:
+            app.logger.exception("could not warm up the MongoDB connection pool")
+
+    threading.Thread(target=ping, name='warm-up', daemon=True).start()
+
+
+def create_app(config=None):
+    #builds a new app. config is a mapping applied over the defaults below and the
+    #environment, e.g. create_app({'TESTING': True, 'MONGODB_SETTINGS': {...}})
     app = Flask(__name__)
     app.config['SECRET_KEY'] = '49c02eb67b7b2c75412ed8cb13a3ffa7'  # Replace with a secure key in production
+    # send large pages (home, view_loans) while the template is still being rendered
+    app.config['STREAM_TEMPLATES'] = False
+    # seconds between in-process overdue sweeps, 0 leaves it to `flask sweep-overdue`
+    app.config['OVERDUE_SWEEP_INTERVAL'] = 0
+    # seconds between in-process rebuilds of the circulation rollups, 0 leaves it to `flask reconcile-stats`
+    app.config['STATS_RECONCILE_INTERVAL'] = 0
+    # seconds between in-process runs of the loan archiver, 0 leaves it to `flask archive-loans`
+    app.config['LOAN_ARCHIVE_INTERVAL'] = 0
+    # serve home, details, make_loan and view_loans from async views on pymongo's async client
+    app.config['ASYNC_DB'] = False
+    # requests and MongoDB commands slower than this (in ms) are logged with their route and query shape
+    app.config['SLOW_REQUEST_MS'] = 500
+    app.config['SLOW_COMMAND_MS'] = 100
+    # MongoDB connection: a full connection string, so replica sets work (add ?replicaSet=...)
+    app.config['MONGODB_URI'] = 'mongodb://localhost:27017/sg_library_db'
+    # connections each worker keeps open (MIN is opened at boot) and may open at most
+    app.config['MONGODB_MIN_POOL_SIZE'] = 5
+    app.config['MONGODB_MAX_POOL_SIZE'] = 100
+    # ms to open a connection, to find a usable server, for a reply, and to wait for a free pooled connection
+    app.config['MONGODB_CONNECT_TIMEOUT_MS'] = 5000
+    app.config['MONGODB_SERVER_SELECTION_TIMEOUT_MS'] = 5000
+    app.config['MONGODB_SOCKET_TIMEOUT_MS'] = 30000
+    app.config['MONGODB_WAIT_QUEUE_TIMEOUT_MS'] = 2000
+    # where catalog reads (home, details, search, /api/books) go, e.g. secondaryPreferred on a
+    # replica set; loans, inventory writes and everything else always use the primary
+    app.config['CATALOG_READ_PREFERENCE'] = 'primary'
+    # seconds a member's catalog reads stay on the primary after they changed something,
+    # so they see their own loan/return instead of a lagging secondary
+    app.config['PRIMARY_READS_AFTER_WRITE'] = 10
+    # open the connection pool when a worker starts instead of on its first request
+    app.config['WARM_UP_CONNECTIONS'] = True
+    # where fetched covers and their thumbnails are stored, and how many are fetched at once
+    app.config['COVER_DIR'] = os.path.join(app.instance_path, 'covers')
+    app.config['COVER_WORKERS'] = 4
+    # covers are only fetched from public http(s) hosts; turn on to allow hosts on private
+    # or loopback addresses, e.g. an image server inside the library's network
+    app.config['COVER_FETCH_PRIVATE_HOSTS'] = False
+    # fetch the cover of a new title in the background when it is added
+    app.config['FETCH_COVERS'] = True
+    # serve catalog pages and details from a memory-mapped snapshot of the catalog that
+    # all workers on a host share, rebuilt in the background when titles change
+    app.config['CATALOG_SNAPSHOT'] = False
+    app.config['CATALOG_SNAPSHOT_DIR'] = os.path.join(app.instance_path, 'catalog')
+    # admission control for the write routes (make_loan, renew_loan, return_loan, add_book),
+    # per worker. WORKER_THREADS is the worker's request threads (gunicorn --threads, 1 for
+    # sync workers); READ_THREADS of them are never taken by the write routes, which together
+    # hold at most the rest, running or waiting. per route: requests running at once, waiting
+    # for a slot, and ms they wait before a 503; Retry-After seconds sent with it
+    app.config['ADMISSION_CONTROL'] = True
+    app.config['WORKER_THREADS'] = 8
+    app.config['READ_THREADS'] = 2
+    app.config['WRITE_CONCURRENCY'] = 4
+    app.config['WRITE_QUEUE'] = 4
+    app.config['WRITE_QUEUE_TIMEOUT_MS'] = 2000
+    app.config['WRITE_RETRY_AFTER'] = 2
+    # writes a member may make per second on average, and in a burst, before getting a 429;
+    # a rate of 0 turns the per-member limit off
+    app.config['MEMBER_WRITE_RATE'] = 0.5
+    app.config['MEMBER_WRITE_BURST'] = 10
+    # open loans a member may hold at once, 0 for no limit
+    app.config['MAX_OPEN_LOANS'] = 0
+    # any setting above can be overridden with a FLASK_<NAME> environment variable
+    app.config.from_prefixed_env()
+    app.config.update(config or {})
+    app.config['CATALOG_READ_PREFERENCE'] = read_preference(app.config['CATALOG_READ_PREFERENCE'])
 
-    # Initialize MongoDB
-    app.config['MONGODB_SETTINGS'] = {
-        'db': 'sg_library_db',
-        'host': 'localhost',
-        'port': 27017
-    }
-    db = MongoEngine(app)
-    login_manager = LoginManager(app)
-    login_manager.login_view = 'login'  # Redirect to login page if unauthenticated or unauthorized
-    return app, db, login_manager
+    # Initialize MongoDB. connect=False defers connecting to the first operation, so a
+    # client is never shared across the fork of a pre-forking server
+    app.config.setdefault('MONGODB_SETTINGS', {
+        'host': app.config['MONGODB_URI'],
+        'connect': False,
+        **mongo_client_options(app.config),
+    })
+
+    # everything below is imported here rather than at the top so that importing the
+    # package stays cheap; see `flask bench-startup`
+    from app.metrics import init_metrics
+    from app.covers import init_covers
+    from app.limiter import limiter
+    from app import aio, snapshot
+    from app.app import main, init_views
+    from app.api import api
 
-# Initialize the app and db instances
-app, db, login_manager = create_app()
\ No newline at end of file
+    # per-request Mongo command counts, Server-Timing headers and /metrics; the command
+    # listener has to be registered before the MongoDB client is created
+    init_metrics(app)
+    # sheds write requests before they reach MongoDB once a route is saturated
+    limiter.init_app(app)
+    # /covers/<id>/<size> and the cover_url() template helper
+    init_covers(app)
+    db.init_app(app)
+    login_manager.init_app(app)
+    csrf.init_app(app)
+    aio.db.init_app(app)
+    snapshot.store.init_app(app)
+    app.register_blueprint(main)
+    app.register_blueprint(api)
+    init_views(app)
+    if app.config['WARM_UP_CONNECTIONS']:
+        warm_up_connections(app)
+    return app
\ No newline at end of file
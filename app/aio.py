@@ -0,0 +1,91 @@
+import asyncio
+import threading
+from pymongo import AsyncMongoClient, uri_parser
+
+
+class AsyncDatabase:
+    #pymongo's async client for the ASYNC_DB views. Flask runs each async view on its own
+    #short-lived event loop, but a client is bound to the loop it first ran on, so the
+    #client lives on one long-lived loop thread and views await their queries there.
+
+    def __init__(self):
+        self.enabled = False
+        self._settings = None
+        self._loop = None
+        self._client = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        from app import mongo_client_options
+        uri = app.config['MONGODB_URI']
+        self.enabled = app.config['ASYNC_DB']
+        self.configure(uri_parser.parse_uri(uri)['database'], uri, **mongo_client_options(app.config))
+
+    def configure(self, name, host='localhost', port=None, **options):
+        #points the async client at another database; connects lazily on the next query
+        with self._lock:
+            client, self._client = self._client, None
+            self._settings = (name, host, port, options)
+        if client is not None:
+            asyncio.run_coroutine_threadsafe(client.close(), self._loop)
+
+    def _database(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='async-mongo', daemon=True).start()
+            name, host, port, options = self._settings
+            if self._client is None:
+                self._client = AsyncMongoClient(host, port, **options)
+            return self._client[name]
+
+    async def run(self, make_coroutine):
+        #make_coroutine(database) is started on the client's loop and awaited from the view's.
+        #run_coroutine_threadsafe starts the task in a copy of the view's context, so the
+        #commands it sends are charged to the view's request (see metrics.CommandMonitor)
+        database = self._database()
+        future = asyncio.run_coroutine_threadsafe(make_coroutine(database), self._loop)
+        return await asyncio.wrap_future(future)
+
+    async def call(self, document, method, *args, read_preference=None, **kwargs):
+        #one collection method of a document class, e.g. call(Loan, 'insert_one', doc)
+        name = document._get_collection_name()
+
+        def start(database):
+            collection = database[name]
+            if read_preference is not None:
+                collection = collection.with_options(read_preference=read_preference)
+            return getattr(collection, method)(*args, **kwargs)
+
+        return await self.run(start)
+
+    async def find(self, queryset, limit=None):
+        #runs a mongoengine queryset (filter, ordering, projection, limit) on the async
+        #client and returns documents, so the query itself is still built by the model
+        document = queryset._document
+        name = document._get_collection_name()
+        limit = queryset._limit or limit
+
+        async def query(database):
+            collection = database[name]
+            if queryset._read_preference is not None:
+                collection = collection.with_options(read_preference=queryset._read_preference)
+            cursor = collection.find(queryset._query, **queryset._cursor_args)
+            if queryset._ordering:
+                cursor = cursor.sort(queryset._ordering)
+            if limit:
+                cursor = cursor.limit(limit)
+            return await cursor.to_list(None)
+
+        return [document._from_son(row) for row in await self.run(query)]
+
+    async def first(self, queryset):
+        rows = await self.find(queryset, limit=1)
+        return rows[0] if rows else None
+
+    async def count(self, queryset):
+        return await self.call(queryset._document, 'count_documents', queryset._query,
+                               read_preference=queryset._read_preference)
+
+
+db = AsyncDatabase()
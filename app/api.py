@@ -0,0 +1,120 @@
+import hashlib
+import json
+import zlib
+from bson import ObjectId
+from bson.errors import InvalidId
+from flask import Blueprint, Response, g, request, jsonify, stream_with_context
+from app.model import Book, CatalogState, PAGE_SIZE
+
+api = Blueprint('api', __name__, url_prefix='/api')
+
+# fields a client may ask for with ?fields=, and what it gets without asking
+API_FIELDS = ('title', 'authors', 'category', 'genres', 'copies', 'available', 'url', 'description', 'pages')
+DEFAULT_FIELDS = ('title', 'authors', 'category', 'genres', 'available')
+MAX_LIMIT = 1000
+
+
+def _requested_fields():
+    names = [name.strip() for name in request.args.get('fields', '').split(',') if name.strip()]
+    return tuple(name for name in names if name in API_FIELDS) or DEFAULT_FIELDS
+
+
+def _serialize(doc, fields):
+    item = {'id': str(doc['_id'])}
+    for name in fields:
+        if name in doc:
+            item[name] = doc[name]
+    return item
+
+
+def _etag():
+    #every response is a function of the catalog version and the query string, which only
+    #holds if the rows come from the primary the version was read from: a lagging secondary
+    #would hand out stale availability under the current version's etag
+    g.render_on_primary = True
+    version, _ = CatalogState.current()
+    return hashlib.sha1(f"{version}:{request.full_path}".encode()).hexdigest()[:20]
+
+
+def _not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def _finish(response, etag):
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def _gzip(chunks):
+    #compresses a stream of str chunks; zlib buffers internally so small items are
+    #batched into reasonably sized gzip blocks
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+@api.route('/books')
+def list_books():
+    etag = _etag()
+    if etag in request.if_none_match:
+        return _not_modified(etag)
+
+    fields = _requested_fields()
+    limit = max(1, min(request.args.get('limit', PAGE_SIZE, type=int), MAX_LIMIT))
+    books = Book.catalog()
+    if request.args.get('category'):
+        books = books.filter(category=request.args['category'])
+    genres = [genre.strip() for genre in request.args.get('genre', '').split(',') if genre.strip()]
+    if genres:
+        books = books.filter(genres__all=genres)
+    position = Book.decode_cursor(request.args['after']) if request.args.get('after') else None
+    if position:
+        books = books.filter(Book.keyset_filter(position))
+    # raw dicts straight off the driver cursor, no Document construction
+    cursor = books.order_by('title', 'id').only('title', *fields).limit(limit + 1).as_pymongo()
+
+    def generate():
+        yield '{"books":['
+        last = None
+        for count, doc in enumerate(cursor):
+            if count == limit:
+                break
+            yield (',' if count else '') + json.dumps(_serialize(doc, fields), separators=(',', ':'))
+            last = doc
+        else:
+            # ran out of rows before the extra one: this is the last page
+            last = None
+        next_cursor = Book.encode_cursor(last['title'], last['_id']) if last else None
+        yield '],"next":' + json.dumps(next_cursor) + '}'
+
+    chunks = generate()
+    headers = {}
+    if 'gzip' in request.accept_encodings:
+        chunks = _gzip(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    response = Response(stream_with_context(chunks), mimetype='application/json', headers=headers)
+    return _finish(response, etag)
+
+
+@api.route('/books/<book_id>')
+def get_book(book_id):
+    try:
+        book_id = ObjectId(book_id)
+    except InvalidId:
+        return jsonify(error="Book not found."), 404
+    etag = _etag()
+    if etag in request.if_none_match:
+        return _not_modified(etag)
+
+    fields = _requested_fields()
+    doc = Book.catalog().filter(id=book_id).only(*fields).as_pymongo().first()
+    if not doc:
+        return jsonify(error="Book not found."), 404
+    return _finish(jsonify(_serialize(doc, fields)), etag)
@@ -1,34 +1,114 @@
-from flask import Flask, render_template, flash, request, session, redirect, url_for
-from app.model import LoginForm, RegForm, Book, User, AddBookForm, Loan
+import asyncio
+import os
+import sys
+import threading
+import time
+import uuid
+import random
+import click
+from concurrent.futures import ThreadPoolExecutor
+from flask import Blueprint, Response, abort, current_app, render_template, flash, request, session, redirect, url_for, jsonify
+from flask import g, get_flashed_messages, stream_with_context
+from mongoengine.errors import NotUniqueError
+from app.model import LoginForm, RegForm, Book, User, AddBookForm, Loan, CatalogState, CirculationStats, check_indexes, PAGE_SIZE
+from app.model import read_own_writes, member_stats, LoanHistory, FacetGroup, MemberStats, ARCHIVE_RETURNED_AFTER_DAYS
+from app.cache import cached_page, form_csrf_token
+from app.idempotency import idempotent, idempotency_key
+from flask_wtf.csrf import generate_csrf
+from app.search import index_book
+from app import aio, covers, snapshot
 from datetime import datetime
-from app import app, db, login_manager
 from flask_login import login_user, logout_user, login_required, current_user
 
-# from .books import all_books
+# the library's pages and its flask commands (cli_group=None keeps them top level)
+main = Blueprint('main', __name__, cli_group=None)
 
-# # Insert all books from books.py into MongoDB if not already present
-# Book.init_books(all_books)
 
+def render_page(template, **context):
+    #render_template, or a streamed response when STREAM_TEMPLATES is on. the page header
+    #goes out first and each card follows as its document comes off the Mongo cursor
+    if not current_app.config['STREAM_TEMPLATES']:
+        return render_template(template, **context)
+    #the session cookie is sent before the body, so flashes must be taken out of it now
+    #and the CSRF token the loan buttons carry must already be in it
+    get_flashed_messages(with_categories=True)
+    generate_csrf()
+    current_app.update_template_context(context)
+    stream = current_app.jinja_env.get_template(template).stream(context)
+    stream.enable_buffering(16)
+    return Response(stream_with_context(stream))
 
-@app.route('/')
+
+def run_periodically(app, job, interval):
+    #background loop for maintenance jobs that can also be run from the CLI
+    while True:
+        time.sleep(interval)
+        try:
+            job()
+        except Exception:
+            app.logger.exception("%s failed", job.__name__)
+
+
+@main.route('/')
+@cached_page
 def home():
-    category = request.args.get('category', "All")
-    if category == "All":
-        books = Book.get_all_books().order_by('title')
-    else:
-        books = Book.objects(category=category).order_by('title')
+    category, genres, available_only = browse_filters()
+    books = Book.get_books_page(
+        category,
+        after=request.args.get('after'),
+        before=request.args.get('before'),
+        genres=genres,
+        available_only=available_only,
+    )
+    # counted from the facet index so the page never has to materialize its books
+    facets = FacetGroup.counts(category, genres, available_only)
+
+    return render_page('home.html', books=books, category=category, total=facets['total'], facets=facets,
+                       genres=genres, available_only=available_only)
 
-    return render_template('home.html', books=books, category=category)
 
+def browse_filters():
+    #(category, genres, available only) selected on the catalog page
+    genres = sorted({genre for genre in request.args.getlist('genre') if genre})
+    return request.args.get('category', "All"), genres, request.args.get('available') == '1'
 
-@app.route('/details/<title>')
+
+@main.route('/details/<title>')
+@cached_page
 def details(title):
     # find book by title
-    book = Book.objects(title=title).first()
+    book = Book.get_by_title(title)
+    if book is None:
+        abort(404)
     return render_template('details.html', book=book)
 
+@main.route('/search')
+def search_books():
+    query = request.args.get('q', '').strip()
+    results = Book.search(query) if query else []
+    return render_template('search.html', query=query, books=[book for book, _ in results])
+
+
+@main.route('/search.json')
+def search_books_json():
+    query = request.args.get('q', '').strip()
+    limit = max(1, min(request.args.get('limit', PAGE_SIZE, type=int), 100))
+    results = Book.search(query, limit) if query else []
+    return jsonify(query=query, results=[
+        {
+            'id': str(book.id),
+            'title': book.title,
+            'authors': book.authors,
+            'category': book.category,
+            'genres': book.genres,
+            'available': book.available,
+            'score': round(score, 4),
+        }
+        for book, score in results
+    ])
+
 # #add_book route for admin user
-# @app.route('/add_book', methods=['GET', 'POST'])
+# @main.route('/add_book', methods=['GET', 'POST'])
 # @login_required
 # def add_book():
 #     if current_user.email != 'admin@lib.sg':
@@ -75,12 +155,12 @@ def details(title):
 #     return render_template('add_book.html', form=form)
 
 # updated add_book route to handle dynamic authors
-@app.route('/add_book', methods=['GET', 'POST'])
+@main.route('/add_book', methods=['GET', 'POST'])
 @login_required
 def add_book():
     if current_user.email != 'admin@lib.sg':
         flash("Access denied. Admin only.", "danger")
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
     
     form = AddBookForm()
     
@@ -147,49 +227,103 @@ def add_book():
                 available=form.copies.data,
                 genres=form.genres.data
             )
-            book.save()
+            try:
+                book.save()
+            except NotUniqueError:
+                flash(f"A book titled '{book.title}' already exists.", "danger")
+                return render_template('add_book.html', form=form, author_count=author_count, form_data=request.form)
+            index_book(book, CatalogState.bump(search=True))
+            read_own_writes()
+            if current_app.config['FETCH_COVERS']:
+                covers.store.schedule([book])
+            CirculationStats.record(book.category, book.genres, titles=1, copies=book.copies)
+            FacetGroup.add(book.category, book.genres, book.available > 0)
             flash(f"Book '{book.title}' added successfully with {len(authors)} author(s)!", "success")
-            return redirect(url_for('add_book'))
+            return redirect(url_for('main.add_book'))
         
         # If there's an error, preserve the form data
         return render_template('add_book.html', form=form, author_count=author_count, form_data=request.form)
     
     return render_template('add_book.html', form=form, author_count=author_count, form_data=None)
 
+#circulation dashboard for the admin user, read from the rollup documents
+@main.route("/admin/stats")
+@login_required
+def admin_stats():
+    if current_user.email != 'admin@lib.sg':
+        flash("Access denied. Admin only.", "danger")
+        return redirect(url_for('main.home'))
+
+    rollups = list(CirculationStats.objects())
+    categories = [rollup for rollup in rollups if rollup.kind == 'category']
+    genres = sorted((rollup for rollup in rollups if rollup.kind == 'genre'),
+                    key=lambda rollup: rollup.loans_total, reverse=True)
+    top_titles = Book.objects(times_borrowed__gt=0).order_by('-times_borrowed').only(
+        'title', 'times_borrowed', 'copies', 'available').limit(10)
+    overdue = Loan.get_overdue_loans().count()
+    return render_template('stats.html', categories=categories, genres=genres,
+                           top_titles=top_titles, overdue=overdue)
+
 #view loans for non-admin user
-@app.route("/make_loan/<title>")
+#the loan operations are POST only (see _forms.html), so prefetchers and link previews
+#cannot trigger them, and idempotent so a retried or double-clicked submit runs once
+@main.route("/make_loan/<title>", methods=["POST"])
 @login_required
+@idempotent
 def make_loan(title):
     # Check if non-admin user
     if current_user.email == 'admin@lib.sg':
         flash("Admin users cannot make loans.", "danger")
-        return redirect(url_for('details', title=title))
+        return redirect(url_for('main.details', title=title))
     
     book = Book.objects(title=title).first()
     if not book:
         flash("Book not found.", "danger")
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
+    if over_loan_limit(MemberStats.get_for(current_user.id)):
+        return redirect(url_for('main.details', title=title))
     
     loan = Loan.create_loan(current_user, book)
     if loan:
+        read_own_writes()
         flash(f"You have successfully loaned '{book.title}'.", "success")
     else:
         flash("Cannot make loan. Book unavailable or you already have an unreturned loan for this book.", "danger")
     
-    return redirect(url_for('details', title=title))
+    return redirect(url_for('main.details', title=title))
+
+
+def over_loan_limit(stats):
+    #MAX_OPEN_LOANS from the member's counters; concurrent checkouts may go one over
+    limit = current_app.config['MAX_OPEN_LOANS']
+    if limit and stats.on_loan >= limit:
+        flash(f"You already have {stats.on_loan} books on loan, the limit is {limit}. "
+              "Return one to borrow another.", "danger")
+        return True
+    return False
+
 
-@app.route("/view_loans")
+@main.route("/view_loans")
 @login_required
 def view_loans():
     if current_user.email == 'admin@lib.sg':
         flash("Admin users do not have loans.", "info")
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
     
-    loans = Loan.get_user_loans(current_user)
-    return render_template('view_loans.html', loans=loans)
+    if current_app.config['STREAM_TEMPLATES']:
+        loans = Loan.iter_user_loans(current_user)
+    else:
+        loans = Loan.get_user_loans(current_user)
+    # also read by the nav badge
+    loan_count = member_stats().loans
+    # loans returned a while ago, read from the archive a page at a time
+    history, history_next = LoanHistory.get_page(current_user, before=request.args.get('history'))
+    return render_page('view_loans.html', loans=loans, loan_count=loan_count,
+                       history=history, history_next=history_next)
 
-@app.route("/renew_loan/<loan_id>")
+@main.route("/renew_loan/<loan_id>", methods=["POST"])
 @login_required
+@idempotent
 def renew_loan(loan_id):
     loan = Loan.get_loan_by_id(loan_id)
     if loan and loan.member == current_user:
@@ -199,23 +333,26 @@ def renew_loan(loan_id):
             flash("Cannot renew loan. Maximum renewals reached or loan is overdue.", "danger")
     else:
         flash("Loan not found.", "danger")
-    return redirect(url_for('view_loans'))
+    return redirect(url_for('main.view_loans'))
 
-@app.route("/return_loan/<loan_id>")
+@main.route("/return_loan/<loan_id>", methods=["POST"])
 @login_required
+@idempotent
 def return_loan(loan_id):
     loan = Loan.get_loan_by_id(loan_id)
     if loan and loan.member == current_user:
         if loan.return_loan():
+            read_own_writes()
             flash("Book returned successfully!", "success")
         else:
             flash("Cannot return loan.", "danger")
     else:
         flash("Loan not found.", "danger")
-    return redirect(url_for('view_loans'))
+    return redirect(url_for('main.view_loans'))
 
-@app.route("/delete_loan/<loan_id>")
+@main.route("/delete_loan/<loan_id>", methods=["POST"])
 @login_required
+@idempotent
 def delete_loan(loan_id):
     loan = Loan.get_loan_by_id(loan_id)
     if loan and loan.member == current_user:
@@ -225,19 +362,97 @@ def delete_loan(loan_id):
             flash("Cannot delete loan. Loan must be returned first.", "danger")
     else:
         flash("Loan not found.", "danger")
-    return redirect(url_for('view_loans'))
+    return redirect(url_for('main.view_loans'))
+
+
+#async versions of the views above, used instead of them when ASYNC_DB is on. they
+#return the same pages; independent queries are awaited together with asyncio.gather
+async def home_async():
+    category, genres, available_only = browse_filters()
+    books = await Book.get_books_page_async(category, after=request.args.get('after'),
+                                            before=request.args.get('before'), genres=genres,
+                                            available_only=available_only)
+    # facet groups are served from memory for the current catalog version
+    facets = FacetGroup.counts(category, genres, available_only)
+    return render_page('home.html', books=books, category=category, total=facets['total'], facets=facets,
+                       genres=genres, available_only=available_only)
+
+
+async def details_async(title):
+    book = await Book.get_by_title_async(title)
+    if book is None:
+        abort(404)
+    return render_template('details.html', book=book)
+
+
+async def make_loan_async(title):
+    if current_user.email == 'admin@lib.sg':
+        flash("Admin users cannot make loans.", "danger")
+        return redirect(url_for('main.details', title=title))
+
+    # read on the primary like make_loan, not from the catalog snapshot or a secondary,
+    # so a title added a moment ago can be loaned in both modes
+    book, stats = await asyncio.gather(aio.db.first(Book.objects(title=title)),
+                                       MemberStats.get_for_async(current_user.id))
+    if not book:
+        flash("Book not found.", "danger")
+        return redirect(url_for('main.home'))
+    if over_loan_limit(stats):
+        return redirect(url_for('main.details', title=title))
+
+    loan = await Loan.create_loan_async(current_user, book)
+    if loan:
+        read_own_writes()
+        flash(f"You have successfully loaned '{book.title}'.", "success")
+    else:
+        flash("Cannot make loan. Book unavailable or you already have an unreturned loan for this book.", "danger")
+    return redirect(url_for('main.details', title=title))
+
+
+async def view_loans_async():
+    if current_user.email == 'admin@lib.sg':
+        flash("Admin users do not have loans.", "info")
+        return redirect(url_for('main.home'))
+
+    loans, stats, (history, history_next) = await asyncio.gather(
+        Loan.get_user_loans_async(current_user), MemberStats.get_for_async(current_user.id),
+        LoanHistory.get_page_async(current_user, before=request.args.get('history')),
+    )
+    g.member_stats = stats
+    return render_page('view_loans.html', loans=loans, loan_count=stats.loans,
+                       history=history, history_next=history_next)
+
+
+def init_views(app):
+    #called by create_app once the blueprint is registered
+    app.add_template_global(idempotency_key)
+    app.add_template_global(form_csrf_token)
+    app.add_template_global(member_stats)
+    if app.config['ASYNC_DB']:
+        for endpoint, view in (('home', cached_page(home_async)),
+                               ('details', cached_page(details_async)),
+                               ('make_loan', login_required(idempotent(make_loan_async))),
+                               ('view_loans', login_required(view_loans_async))):
+            app.view_functions[f'main.{endpoint}'] = view
+
+    for job, setting in ((Loan.sweep_overdue, 'OVERDUE_SWEEP_INTERVAL'),
+                         (CirculationStats.reconcile, 'STATS_RECONCILE_INTERVAL'),
+                         (Loan.archive_returned, 'LOAN_ARCHIVE_INTERVAL')):
+        if app.config[setting]:
+            threading.Thread(target=run_periodically, args=(app, job, app.config[setting]),
+                             name=job.__name__, daemon=True).start()
 
 
-@app.route("/logout")
+@main.route("/logout")
 @login_required
 def logout():
     logout_user()
     flash("You have been logged out.", "info")
-    return redirect(url_for("home"))
+    return redirect(url_for("main.home"))
 
 
 # create a route for login page
-@app.route("/login", methods=["GET", "POST"])
+@main.route("/login", methods=["GET", "POST"])
 #function for login
 def login():
     form = LoginForm()
@@ -252,13 +467,13 @@ def login():
         if user:
             login_user(user, remember=form.remember_me.data)  #login the user
             flash("Login successful!", "success")
-            return redirect(url_for("home")) #redirect to function home after login
+            return redirect(url_for("main.home")) #redirect to function home after login
         else:
             flash("Invalid email or password", "danger")
-            return redirect(url_for("login")) #redirect to function login
+            return redirect(url_for("main.login")) #redirect to function login
         
 # create route for registration page
-@app.route("/register", methods=["GET", "POST"])
+@main.route("/register", methods=["GET", "POST"])
 def register():
     form = RegForm()
     if request.method == "GET":
@@ -274,8 +489,246 @@ def register():
             flash("Registration successful. Please log in.", "success")
         else:
             flash("Registration failed. User may already exist.", "danger")
-        return redirect(url_for("login")) #redirect to function login after registration
+        return redirect(url_for("main.login")) #redirect to function login after registration
     return render_template("register.html", form=form)
 
+#flask ensure-indexes: build the declared indexes and fail if a hot query still scans the collection
+@main.cli.command("ensure-indexes")
+@click.option("--verify-only", is_flag=True, help="Only compare and explain, do not create indexes.")
+def ensure_indexes(verify_only):
+    missing, collscans = check_indexes(create=not verify_only)
+    for index in missing:
+        click.echo(f"missing index  {index}")
+    for name in collscans:
+        click.echo(f"COLLSCAN       {name}")
+    if missing or collscans:
+        sys.exit(1)
+    click.echo("All indexes present; no query shape does a collection scan.")
+
+#flask sweep-overdue: mark loans past their due date as overdue, e.g. from cron
+@main.cli.command("sweep-overdue")
+def sweep_overdue():
+    flipped = Loan.sweep_overdue()
+    click.echo(f"{flipped} loan(s) became overdue; {Loan.get_overdue_loans().count()} overdue in total.")
+
+#flask archive-loans: move loans returned more than --older-than-days ago to loan_history
+@main.cli.command("archive-loans")
+@click.option("--older-than-days", default=ARCHIVE_RETURNED_AFTER_DAYS, show_default=True,
+              help="Only archive loans returned at least this many days ago.")
+@click.option("--batch-size", default=1000, show_default=True, help="Loans copied and deleted per batch.")
+def archive_loans(older_than_days, batch_size):
+    moved = Loan.archive_returned(older_than_days, batch_size)
+    click.echo(f"Archived {moved} returned loan(s); {Loan.objects.count()} left in loans, "
+               f"{LoanHistory.objects.count()} in loan_history.")
+
+#flask build-snapshot: write the catalog snapshot for the current catalog version, e.g. before
+#the workers start, so none of them reads the catalog from MongoDB while it is being built
+@main.cli.command("build-snapshot")
+def build_snapshot():
+    path = snapshot.store.build()
+    if path is None:
+        click.echo("Another process is building the snapshot for this catalog version.")
+    else:
+        click.echo(f"Catalog snapshot: {path} ({os.path.getsize(path)} bytes).")
+
+#flask reconcile-members: rebuild every member's loan counters from loans and loan_history
+@main.cli.command("reconcile-members")
+def reconcile_members():
+    members = MemberStats.reconcile()
+    click.echo(f"Recounted the loan counters of {members} member(s) with loans.")
+
+#flask reconcile-stats: rebuild the circulation rollups and facet groups from the books collection
+@main.cli.command("reconcile-stats")
+@click.option("--recount-loans", is_flag=True, help="Also recount times_borrowed for every title from loans.")
+def reconcile_stats(recount_loans):
+    rollups = CirculationStats.reconcile(recount_loans=recount_loans)
+    groups = FacetGroup.rebuild()
+    click.echo(f"Rebuilt {rollups} circulation rollup(s) and {groups} facet group(s).")
+
+#flask import-books [PATH]: stream books from a JSON Lines or CSV file (or the seed
+#catalog in app/data/books.jsonl when no path is given) into MongoDB with batched bulk upserts
+@main.cli.command("import-books")
+@click.argument("path", required=False, type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "file_format", type=click.Choice(["auto", "jsonl", "csv"]), default="auto",
+              show_default=True, help="Input format; auto picks it from the file extension.")
+@click.option("--batch-size", default=1000, show_default=True, help="Books validated and written per bulk write.")
+@click.option("--covers/--no-covers", "fetch_covers", default=True, show_default=True,
+              help="Fetch and resize the covers of new or changed titles after importing.")
+def import_books_command(path, file_format, batch_size, fetch_covers):
+    from app import importer
+
+    started = time.perf_counter()
+    path = path or importer.SEED_CATALOG
+    if file_format == "auto":
+        file_format = "csv" if path.lower().endswith(".csv") else "jsonl"
+    reader = importer.read_csv if file_format == "csv" else importer.read_jsonl
+    with open(path, newline="", encoding="utf-8") as stream:
+        stats = importer.import_books(reader(stream), batch_size)
+    elapsed = time.perf_counter() - started
+    # imports can add titles and move existing ones between categories and genres
+    CirculationStats.reconcile()
+    FacetGroup.rebuild()
+
+    for line_no, reason in stats['rejects']:
+        click.echo(f"rejected row {line_no}: {reason}")
+    if stats['rejected'] > len(stats['rejects']):
+        click.echo(f"... and {stats['rejected'] - len(stats['rejects'])} more rejected rows")
+    unchanged = stats['read'] - stats['inserted'] - stats['updated'] - stats['rejected']
+    click.echo(f"{stats['read']} rows in {elapsed:.2f}s ({stats['read'] / max(elapsed, 1e-9):.0f} rows/s): "
+               f"{stats['inserted']} new, {stats['updated']} updated, {unchanged} unchanged, "
+               f"{stats['rejected']} rejected")
+    if fetch_covers:
+        fetch_covers_command.callback()
+
+#flask fetch-covers: download and resize every cover that is missing or whose url changed
+@main.cli.command("fetch-covers")
+def fetch_covers_command():
+    started = time.perf_counter()
+    books = Book.objects(url__ne=None).only('url', 'cover_source')
+    fetched, failed = covers.wait_for(covers.store.schedule(books))
+    click.echo(f"{fetched} covers fetched, {failed} failed in {time.perf_counter() - started:.1f}s")
+
+#flask bench-search: query latency of the in-process search index over a synthetic catalog
+@main.cli.command("bench-search")
+@click.option("--titles", default=100000, show_default=True, help="Synthetic titles to index.")
+@click.option("--queries", default=2000, show_default=True, help="Random queries to time.")
+def bench_search(titles, queries):
+    from app.search import SearchIndex
+
+    rng = random.Random(42)
+    words = [''.join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(3, 9)))
+             for _ in range(20000)]
+    genres = ["Fantasy", "Fiction", "Romance", "Poetry", "Nonfiction", "Psychology", "Magic", "School"]
+    index = SearchIndex()
+    started = time.perf_counter()
+    for i in range(titles):
+        index.add(i, ' '.join(rng.choices(words, k=4)), [' '.join(rng.choices(words, k=2))],
+                  rng.sample(genres, 2), [' '.join(rng.choices(words, k=40))])
+    click.echo(f"indexed {titles} titles in {time.perf_counter() - started:.1f}s")
+
+    timings = []
+    for _ in range(queries):
+        query = ' '.join(rng.choices(words, k=rng.randint(1, 2)))
+        if rng.random() < 0.3:
+            query = query[:3]
+        started = time.perf_counter()
+        index.search(query)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    pick = lambda q: timings[min(len(timings) - 1, int(len(timings) * q))]
+    click.echo(f"{queries} queries: p50 {pick(0.5):.2f}ms  p95 {pick(0.95):.2f}ms  p99 {pick(0.99):.2f}ms")
+
+#flask bench-routes: seed a scratch database and load-test the member routes against it.
+#fails when a route got slower or needs more Mongo commands than the stored baseline
+@main.cli.command("bench-routes")
+@click.option("--database", default="sg_library_bench", show_default=True, help="Scratch database, dropped and reseeded.")
+@click.option("--titles", default=5000, show_default=True)
+@click.option("--members", default=50, show_default=True)
+@click.option("--loans", "loans_per_member", default=3, show_default=True, help="Loans seeded per member.")
+@click.option("--concurrency", default=8, show_default=True, help="Members hitting the routes at once.")
+@click.option("--requests", default=20, show_default=True, help="Requests per member and route.")
+@click.option("--baseline", default="bench_baseline.json", show_default=True, type=click.Path(dir_okay=False))
+@click.option("--save-baseline", is_flag=True, help="Store this run as the new baseline.")
+@click.option("--tolerance", default=0.25, show_default=True, help="Allowed p95 slowdown against the baseline.")
+@click.option("--seed", "seed_value", default=1, show_default=True)
+def bench_routes(database, titles, members, loans_per_member, concurrency, requests,
+                 baseline, save_baseline, tolerance, seed_value):
+    from app import bench
+
+    rng = random.Random(seed_value)
+    bench.use_database(database, current_app.config)
+    started = time.perf_counter()
+    bench.seed(titles, members, loans_per_member, rng)
+    click.echo(f"seeded {titles} titles, {members} members in {time.perf_counter() - started:.1f}s")
+
+    results = bench.run(current_app._get_current_object(), min(concurrency, members), requests, rng)
+    click.echo(f"{'route':<12}{'requests':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'req/s':>9}{'cmds/req':>10}")
+    for route, row in results.items():
+        click.echo(f"{route:<12}{row['requests']:>9}{row['p50']:>9.1f}{row['p95']:>9.1f}{row['p99']:>9.1f}"
+                   f"{row['rps']:>9.0f}{row['commands']:>10.2f}")
+
+    stored = bench.load_baseline(baseline)
+    if save_baseline or stored is None:
+        bench.save_baseline(baseline, results)
+        click.echo(f"baseline written to {baseline}")
+        return
+    problems = bench.compare(results, stored, tolerance)
+    for problem in problems:
+        click.echo(f"REGRESSION {problem}")
+    if problems:
+        sys.exit(1)
+    click.echo("no regressions against the baseline")
+
+#flask bench-startup: how long a fresh interpreter takes to import the package and build
+#the app. fails when the median is over the budget, so slow imports do not creep back in
+@main.cli.command("bench-startup")
+@click.option("--runs", default=5, show_default=True, help="Fresh interpreters to time.")
+@click.option("--budget-ms", default=500.0, show_default=True, help="Allowed median import and create_app time.")
+@click.option("--top", default=10, show_default=True, help="Slowest top-level imports to list.")
+def bench_startup(runs, budget_ms, top):
+    from app import bench
+
+    median, imports = bench.measure_startup(runs)
+    for cumulative, module in imports[:top]:
+        click.echo(f"{cumulative:>9.1f} ms  {module}")
+    click.echo(f"import + create_app: {median:.1f} ms median of {runs} runs (budget {budget_ms:.0f} ms)")
+    if median > budget_ms:
+        click.echo(f"OVER BUDGET by {median - budget_ms:.1f} ms")
+        sys.exit(1)
+
+#flask stress-checkout: hammer one title from N threads in a scratch database and check
+#that available always equals copies minus open loans afterwards
+@main.cli.command("stress-checkout")
+@click.option("--database", default="sg_library_stress", show_default=True, help="Scratch database, dropped and reseeded.")
+@click.option("--workers", default=16, show_default=True, help="Parallel members checking out the same title.")
+@click.option("--copies", default=5, show_default=True, help="Copies of the scratch title.")
+@click.option("--rounds", default=50, show_default=True, help="Checkout attempts per worker.")
+def stress_checkout(database, workers, copies, rounds):
+    from app import bench
+
+    # loans move the circulation rollups, facet groups and member counters too, so the
+    # run never touches the library's own database
+    bench.use_database(database, current_app.config)
+    bench.reset()
+    tag = uuid.uuid4().hex[:8]
+    book = Book(title=f"Stress test {tag}", authors=["Stress"], category="Adult",
+                copies=copies, available=copies)
+    book.save()
+    members = [User.create_user(name=f"stress-{tag}-{i}", email=f"stress-{tag}-{i}@lib.sg", password_hash=tag)
+               for i in range(workers)]
+
+    def run(member):
+        loaned = 0
+        lowest = copies
+        for _ in range(rounds):
+            copy = Book(id=book.id, copies=copies)
+            loan = Loan.create_loan(member, copy)
+            if loan:
+                loaned += 1
+                lowest = min(lowest, copy.available)
+                if random.random() < 0.5:
+                    loan.return_loan()
+        return loaned, lowest
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(run, members))
+    elapsed = time.perf_counter() - started
+
+    book.reload()
+    open_loans = Loan.objects(book=book, returned=False).count()
+    checkouts = sum(loaned for loaned, _ in results)
+    lowest = min(low for _, low in results)
+    click.echo(f"{checkouts} checkouts by {workers} workers in {elapsed:.2f}s "
+               f"({checkouts / elapsed:.1f} checkouts/s)")
+    click.echo(f"copies={copies} available={book.available} open loans={open_loans} lowest seen={lowest}")
+
+    bench.reset()
+    if book.available != copies - open_loans or lowest < 0:
+        click.echo("FAIL: available drifted from copies - open loans")
+        sys.exit(1)
+    click.echo("OK: no drift")
+
 if __name__ == '__main__':
-    app.run()
\ No newline at end of file
+    from app import create_app
+    create_app().run()
\ No newline at end of file
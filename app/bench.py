@@ -0,0 +1,274 @@
+import json
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import CookieJar
+import mongoengine
+from werkzeug.serving import WSGIRequestHandler, make_server
+from app import aio
+from app.limiter import limiter
+from app.model import Book, User, Loan, LoanHistory, CatalogState, CirculationStats, MemberStats, FacetGroup
+
+# routes the suite drives, in the order they run, and the ones that are POSTed
+ROUTES = ('home', 'details', 'make_loan', 'view_loans', 'renew_loan', 'return_loan')
+WRITE_ROUTES = ('make_loan', 'renew_loan', 'return_loan')
+BENCH_PASSWORD = 'bench-password'
+CATEGORIES = ("Children", "Teens", "Adult")
+GENRES = ("Fantasy", "Fiction", "Romance", "Poetry", "Nonfiction", "Psychology", "Magic", "School")
+SERVER_TIMING_COMMANDS = re.compile(r'"(\d+) mongo commands"')
+COLLECTIONS = (Book, User, Loan, LoanHistory, CatalogState, CirculationStats, MemberStats, FacetGroup)
+
+
+def scratch_uri(uri, name):
+    #uri with its database swapped for name. credentials keep authenticating against the
+    #database they were given for, which the uri's database is when it has no authSource
+    parts = urllib.parse.urlsplit(uri)
+    query = urllib.parse.parse_qs(parts.query)
+    if '@' in parts.netloc and 'authSource' not in query:
+        query['authSource'] = [parts.path.strip('/') or 'admin']
+    return urllib.parse.urlunsplit(parts._replace(path=f"/{name}", query=urllib.parse.urlencode(query, doseq=True)))
+
+
+def use_database(name, config):
+    #points every model at a scratch database on the deployment MONGODB_URI names, with the
+    #app's client options, so seeding never touches the library data. the new client
+    #picks up the command monitor registered by create_app
+    from app import mongo_client_options
+    uri = scratch_uri(config['MONGODB_URI'], name)
+    options = mongo_client_options(config)
+    mongoengine.disconnect()
+    mongoengine.connect(name, host=uri, **options)
+    aio.db.configure(name, uri, **options)
+    for document in COLLECTIONS:
+        document._collection = None
+
+
+def reset():
+    #empties the scratch database and creates the indexes the loan routes rely on
+    for document in COLLECTIONS:
+        document.drop_collection()
+        document._collection = None
+    for document in (Book, User, Loan):
+        document.ensure_indexes()
+
+
+def seed(titles, members, loans_per_member, rng):
+    #synthetic catalog and member population; loans go through create_loan so every
+    #counter and rollup is consistent with what the routes expect
+    reset()
+
+    batch = []
+    for i in range(titles):
+        copies = rng.randint(1, 5)
+        batch.append(Book(
+            title=f"Bench Title {i:07d}",
+            authors=[f"Author {rng.randint(1, titles // 10 + 1)}"],
+            category=rng.choice(CATEGORIES),
+            genres=rng.sample(GENRES, 2),
+            copies=copies,
+            available=copies,
+            url="https://example.invalid/cover.jpg",
+            description=["First paragraph " * 10, "Last paragraph " * 10],
+            pages=rng.randint(20, 800),
+        ))
+        if len(batch) == 1000:
+            Book.bulk_upsert(batch)
+            batch = []
+    Book.bulk_upsert(batch)
+
+    users = [User(name=f"bench-{i}", email=f"bench-{i}@lib.sg", password_hash=BENCH_PASSWORD)
+             for i in range(members)]
+    User.objects.insert(users, load_bulk=False)
+    book_ids = Book.objects.scalar('id')
+    for user in User.objects():
+        for book_id in rng.sample(list(book_ids[:5000]), min(loans_per_member, len(book_ids))):
+            Loan.create_loan(user, Book(id=book_id))
+    CirculationStats.reconcile()
+    FacetGroup.rebuild()
+
+
+# what bench-startup times in a fresh interpreter: importing the package and building an app
+STARTUP_SCRIPT = (
+    "import time; started = time.perf_counter(); from app import create_app; "
+    "create_app({'WARM_UP_CONNECTIONS': False}); print((time.perf_counter() - started) * 1000)"
+)
+
+
+def measure_startup(runs):
+    #(median ms, [(cumulative ms, module)] slowest imports made directly by the startup).
+    #every run is a new interpreter, so nothing is cached in memory; one more run with
+    #-X importtime (which slows imports down) breaks the time down by module
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    def start(*options):
+        return subprocess.run([sys.executable, *options, '-c', STARTUP_SCRIPT],
+                              cwd=root, capture_output=True, text=True, check=True)
+
+    timings = [float(start().stdout.strip().splitlines()[-1]) for _ in range(runs)]
+    imports = []
+    for line in start('-X', 'importtime').stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package", indented two spaces per level
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        depth = (len(parts[2]) - len(parts[2].lstrip()) - 1) // 2
+        if depth <= 1:
+            imports.append((int(parts[1]) / 1000, parts[2].strip()))
+    return statistics.median(timings), sorted(imports, reverse=True)
+
+
+def percentile(timings, q):
+    return timings[min(len(timings) - 1, int(len(timings) * q))] if timings else 0.0
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    #a write route answers with a redirect; only the route itself is timed
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class QuietHandler(WSGIRequestHandler):
+    #no access log line for every bench request
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def serve(app):
+    #the app on a free local port, one thread per request like a threaded worker.
+    #returns (server, base url); stop it with server.shutdown()
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, name='bench-server', daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def mongo_commands(response):
+    #the count from the Server-Timing header app/metrics.py sets, e.g. desc="3 mongo commands"
+    match = SERVER_TIMING_COMMANDS.search(response.headers.get('Server-Timing', ''))
+    return int(match.group(1)) if match else 0
+
+
+class Worker:
+    #one logged-in member driving the app over HTTP with its own session cookie
+
+    def __init__(self, base_url, email, titles, rng):
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()), NoRedirect)
+        self.base_url = base_url
+        self.email = email
+        self.titles = titles
+        self.rng = rng
+        self.request('/login', {'email': email, 'password': BENCH_PASSWORD})
+
+    def request(self, path, form=None):
+        #GET, or POST when form is given; redirects and error pages come back as responses
+        data = urllib.parse.urlencode(form).encode() if form is not None else None
+        try:
+            response = self.opener.open(self.base_url + urllib.parse.quote(path, safe='/?=&'), data)
+        except urllib.error.HTTPError as error:
+            response = error
+        with response:
+            response.read()
+        return response
+
+    def open_loan_ids(self, renewable=False):
+        loans = Loan.objects(member=User.objects(email=self.email).first(), returned=False)
+        if renewable:
+            loans = loans.filter(status='active', renew_count__lt=2)
+        return [str(loan_id) for loan_id in loans.scalar('id')]
+
+    def urls(self, route, count):
+        if route == 'home':
+            return [f"/?category={self.rng.choice(('All',) + CATEGORIES)}&genre={self.rng.choice(GENRES)}"
+                    for _ in range(count)]
+        if route in ('details', 'make_loan'):
+            return [f"/{route}/{self.rng.choice(self.titles)}" for _ in range(count)]
+        if route == 'view_loans':
+            return ['/view_loans'] * count
+        loan_ids = self.open_loan_ids(renewable=route == 'renew_loan')
+        return [f"/{route}/{loan_id}" for loan_id in loan_ids[:count]]
+
+    def run(self, route, count):
+        timings, commands = [], []
+        for url in self.urls(route, count):
+            started = time.perf_counter()
+            form = {'idempotency_key': uuid.uuid4().hex} if route in WRITE_ROUTES else None
+            response = self.request(url, form)
+            timings.append((time.perf_counter() - started) * 1000)
+            commands.append(mongo_commands(response))
+        return timings, commands
+
+
+def run(app, concurrency, requests, rng):
+    #drives every route with `concurrency` parallel members, `requests` times each, against
+    #the app served on a local port. returns {route: {p50, p95, p99, rps, commands}}
+    # bench members fire requests back to back, far faster than a member's token bucket
+    # allows; the per-route limits stay on
+    limiter.buckets_enabled = False
+    # the workers post without the CSRF token a browser gets with the page
+    app.config['WTF_CSRF_ENABLED'] = False
+    titles = list(Book.objects.scalar('title')[:5000])
+    emails = list(User.objects(name__startswith='bench-').scalar('email')[:concurrency])
+    # the bench server runs a thread for every member, more than a worker usually has
+    limiter.size(app.config, len(emails) + app.config['READ_THREADS'])
+    server, base_url = serve(app)
+    try:
+        workers = [Worker(base_url, email, titles, random.Random(rng.random())) for email in emails]
+        results = {}
+        with ThreadPoolExecutor(max_workers=len(workers)) as pool:
+            for route in ROUTES:
+                started = time.perf_counter()
+                outcomes = list(pool.map(lambda worker: worker.run(route, requests), workers))
+                elapsed = time.perf_counter() - started
+                timings = sorted(t for worker_timings, _ in outcomes for t in worker_timings)
+                commands = [c for _, worker_commands in outcomes for c in worker_commands]
+                results[route] = {
+                    'requests': len(timings),
+                    'p50': percentile(timings, 0.50),
+                    'p95': percentile(timings, 0.95),
+                    'p99': percentile(timings, 0.99),
+                    'rps': len(timings) / elapsed if elapsed else 0.0,
+                    'commands': sum(commands) / len(commands) if commands else 0.0,
+                }
+    finally:
+        server.shutdown()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    #regressions against a stored baseline: any route whose p95 grew by more than
+    #tolerance, or that now needs more Mongo commands per request
+    problems = []
+    for route, stored in baseline.items():
+        current = results.get(route)
+        if not current or not current['requests']:
+            continue
+        if current['p95'] > stored['p95'] * (1 + tolerance):
+            problems.append(f"{route}: p95 {current['p95']:.1f}ms > baseline {stored['p95']:.1f}ms")
+        if current['commands'] > stored['commands'] + 0.05:
+            problems.append(f"{route}: {current['commands']:.2f} Mongo commands/request "
+                            f"> baseline {stored['commands']:.2f}")
+    return problems
+
+
+def load_baseline(path):
+    try:
+        with open(path) as stream:
+            return json.load(stream)
+    except FileNotFoundError:
+        return None
+
+
+def save_baseline(path, results):
+    with open(path, 'w') as stream:
+        json.dump(results, stream, indent=2, sort_keys=True)
@@ -1,173 +0,0 @@
-all_books = [
-    {
-        'genres': ["Fantasy","Dark Academia", "Fiction", "Romance"]
-        , 'title': "Katabasis"
-        , 'category': "Adult" 
-        , 'url': "https://images-na.ssl-images-amazon.com/images/S/compressed.photo.goodreads.com/books/1738769146i/210223811.jpg"
-        , 'description': [
-            """Two graduate students must set aside their rivalry and journey to Hell to save their professor's soul, perhaps at the copies of their own."""
-            , """Alice Law has only ever had one goal: to become one of the brightest minds in the field of Magick. She has sacrificed everything to make that a reality—her pride, her health, her love life, and most definitely her sanity. All to work with Professor Jacob Grimes at Cambridge, the greatest magician in the world—that is, until he dies in a magical accident that could possibly be her fault."""
-            ,"""Grimes is now in Hell, and she's going in after him. Because his recommendation could hold her very future in his now incorporeal hands, and even death is not going to stop the pursuit of her dreams. Nor will the fact that her rival, Peter Murdoch, has come to the same conclusion. """
-        ]
-        , 'authors' :["R.F. Kuang"]
-        , 'pages': 400
-        , 'available': 2
-        , 'copies': 2
-    }, 
-
-    {
-        'genres': ["Fantasy", "Romance", "Fiction", "Magic"]
-        , 'title': "Accomplice to the Villain"
-        , 'category': 'Adult' 
-        , 'url': "https://images-na.ssl-images-amazon.com/images/S/compressed.photo.goodreads.com/books/1733486325i/220892644.jpg"
-        , 'description': [
-            """Once Upon a Time meets The Office in Hannah Nicole Maehrer's laugh-out-loud viral TikTok series turned novel, about the sunshine assistant to an Evil Villain…and their unexpected romance."""
-            , """REWARD OFFERED: Apprentice to The Villain wanted for treason (light), magical property damage (alleged), and one incident involving a weaponized scone (accurate). Frequently seen with a grumpy frog (crowned, judgmental). Answers to "Evie" or "Stop that"."""
-            , """Evie Sage didn't mean to become the right-hand woman to the kingdom's most terrifying villain. One minute, she was applying for an entry-level position that promised "light paperwork and occasional beheadings", and the next, she was knee-deep in magical mayhem, murder plots, and an entirely inappropriate crush on her brooding, sharp-jawed, walking disaster of a boss."""
-            , """Now, with a magical prophecy unraveling, assassins showing up in the break room, and a suspicious amount of frogs wearing crowns, Evie has to figure out how to survive her job without setting the kingdom on fire—or her dignity, which is hanging by a very sarcastic thread."""
-            , """Being evil-adjacent was never part of the five-year plan. But then again…neither was falling for The Villain."""
-            , """A magical office comedy with grumpy bosses, snarky frogs, and definitely-not-feelings."""
-        ]
-        , 'authors' :["Hannah Nicole Maehrer"]
-        , 'pages': 482
-        , 'available': 0
-        , 'copies': 2
-    }, 
-
-    {
-        'genres': ["Picture Books", "Fiction", "School"]
-        , 'title': "The Day the Books Disappeared"
-        , 'category': 'Children' 
-        , 'url': "https://images-na.ssl-images-amazon.com/images/S/compressed.photo.goodreads.com/books/1740238803i/221254293.jpg"
-        , 'description': [
-            """All-star authors Joanna Ho (Eyes That Kiss in the Corners) and Caroline Kusin Pritchard (The Keeper of Stories) team up with Caldecott Medalist and National Book Award Winner Dan Santat in this celebration of the freedom to read."""
-            , """Arnold didn't mean for the books to disappear—not exactly. It all started because he liked his book about airplanes best. Why would anyone want to read about tomatoes or ostriches or submarines (ew, the worst!) when they could read about planes, instead?"""
-            , """When Arnold realizes—POOF!—he can make the other books vanish, he goes a little too far. Before he knows it, all the books are gone-including his. Can Arnold figure out how to bring them back before it's too late?"""
-            , """This book about books celebrates themes of empathy, interconnectedness, and the value of diverse and differing perspectives. """
-        ]
-        , 'authors' :["Joanna Ho", "Caroline Kusin Pritchard", "Dan Santat (Illustrator)"]
-        , 'pages': 40
-        , 'available': 2
-        , 'copies': 2
-    }, 
-
-    {
-        'genres': ["Picture Books", "Emotion", "Mental Health", "Fiction", "Grief"]
-        , 'title': "When Sadness is at Your Door"
-        , 'category': 'Children' 
-        , 'url': "https://images-na.ssl-images-amazon.com/images/S/compressed.photo.goodreads.com/books/1530004182i/40641149.jpg"
-        , 'description': [
-            """In the style of Harold and the Purple Crayon comes a picture-book primer in emotional literacy and mindfulness that suggests we approach the feeling of sadness as if it is our guest."""
-            , """Sadness can be scary and confusing at any age! When we feel sad, especially for long periods of time, it can seem as if the sadness is a part of who we are--an overwhelming, invisible, and scary sensation."""
-            , """In When Sadness Is at Your Door, Eva Eland brilliantly approaches this feeling as if it is a visitor. She gives it a shape and a face, and encourages the reader to give it a name, all of which helps to demystify it and distinguish it from ourselves. She suggests activities to do with it, like sitting quietly, drawing, and going outside for a walk. The beauty of this approach is in the respect the book has for the feeling, and the absence of a narrative that encourages the reader to "get over" it or indicates that it's "bad", both of which are anxiety-producing notions."""
-            , "Simple illustrations that recall the classic style of Crockett Johnson (Harold and the Purple Crayon) invite readers to add their own impressions."""
-            , """Eva Eland's debut picture book is a great primer in mindfulness and emotional literacy, perfect for kids navigating these new feelings - and for adult readers tackling the feelings themselves!"""
-        ]
-        , 'authors' :["Eva Eland"]
-        , 'pages': 32
-        , 'available': 1
-        , 'copies': 1
-    }, 
-
-    {
-        'genres': ["Graphic Novels", "Picture Books", "Fantasy", "Animals", "Friendship"]
-        , 'title': "Tiger vs. Nightmare"
-        , 'category': 'Children' 
-        , 'url': "https://images-na.ssl-images-amazon.com/images/S/compressed.photo.goodreads.com/books/1521682841i/37534387.jpg"
-        , 'description': [
-            """Tiger is a very lucky kid: she has a monster living under her bed. Every night, Tiger and Monster play games until it's time for lights out. Of course, Monster would never try to scare Tiger—that's not what best friends do."""
-            , """But Monster needs to scare someone…it's a monster, after all. So while Tiger sleeps, Monster scares all of her nightmares away. Thanks to her friend, Tiger has nothing but good dreams. But waiting in the darkness is a nightmare so big and mean that Monster can't fight it alone. Only teamwork and a lot of bravery can chase this nightmare away."""
-            , """In this charming graphic novel for young readers, cartoonist Emily Tetri proves that unlikely best friends can be an unbeatable team, even agianst the scariest monsters."""
-            ]
-        , 'authors' :["Emily Tetri"]
-        , 'pages': 64
-        , 'available': 1
-        , 'copies': 1
-    }, 
-
-
-    {
-        'genres': ["Historical Fiction", "Poetry", "Fiction"]
-        , 'title': "The Door of No Return"
-        , 'category': 'Teens' 
-        , 'url': "https://images-na.ssl-images-amazon.com/images/S/compressed.photo.goodreads.com/books/1641982510i/60021207.jpg"
-        , 'description': [
-            """The first book in a trilogy that tells the story of a boy, a village, and the epic odyssey of an African family."""
-            , """In his village in Upper Kwanta, 11-year-old Kofi loves his family, playing oware with his grandfather and swimming in the river Offin. He's warned though, to never go to the river at night. His brother tells him "There are things about the water you do not know." "Like what?" Kofi asks. "The beasts,”"his brother answers."""
-            , """One fateful night, the unthinkable happens, and in a flash, Kofi's world turns upside down. Kofi soon ends up in a fight for his life and what happens next will send him on a harrowing journey across land and sea, and away from everything he loves."""
-        ]    
-        , 'authors' :["Kwame Alexander"]
-        , 'pages': 432
-        , 'available': 1
-        , 'copies': 1
-    }, 
-
-
-    {
-        'genres': ["Graphic Novels", "Indigenous", "Fiction", "Comics"]
-        , 'title': "Borders"
-        , 'category': 'Teens' 
-        , 'url': "https://images-na.ssl-images-amazon.com/images/S/compressed.photo.goodreads.com/books/1633711462i/24447097.jpg"
-        , 'description': [
-            """A stunning graphic-novel adaptation based on the work of one of Canada’s most revered and bestselling authors."""
-            , """On a trip to visit his older sister, who has moved away from the family home on the reserve to Salt Lake City, a young boy and his mother are posed a simple question with a not-so-simple answer. Are you Canadian, the border guards ask, or American?"""
-            , """ "Blackfoot." """
-            , """And when border guards will not accept their citizenship, mother and son wind up trapped in an all-too-real limbo between nations that do not recognize who they are."""
-            , """A powerful graphic-novel adaptation of one of Thomas King's most celebrated short stories, Borders explores themes of identity and belonging, and is a poignant depiction of the significance of a nation's physical borders from an Indigenous perspective. This timeless story is brought to vibrant, piercing life by the singular vision of artist Natasha Donovan."""
-        ]
-        , 'authors' :["Thomas King", "Natasha Donovan (Illustrator)"]
-        , 'pages': 192
-        , 'available': 1
-        , 'copies': 1
-    }, 
-
-    {
-        'genres': ["Nonfiction", "Self Help", "Psychology", "Personal Development", "Productivity", "Business"]
-        , 'title': "Atomic Habits: An Easy & Proven Way to Build Good Habits & Break Bad Ones"
-        , 'category': 'Adult' 
-        , 'url': "https://images-na.ssl-images-amazon.com/images/S/compressed.photo.goodreads.com/books/1655988385i/40121378.jpg"
-        , 'description': [
-            """No matter your goals, Atomic Habits offers a proven framework for improving—every day. James Clear, one of the world's leading experts on habit formation, reveals practical strategies that will teach you exactly how to form good habits, break bad ones, and master the tiny behaviors that lead to remarkable results."""
-            , """If you're having trouble changing your habits, the problem isn't you. The problem is your system. Bad habits repeat themselves again and again not because you don't want to change, but because you have the wrong system for change. You do not rise to the level of your goals. You fall to the level of your systems. Here, you'll get a proven system that can take you to new heights."""
-            , """Clear is known for his ability to distill complex topics into simple behaviors that can be easily applied to daily life and work. Here, he draws on the most proven ideas from biology, psychology, and neuroscience to create an easy-to-understand guide for making good habits inevitable and bad habits impossible. Along the way, readers will be inspired and entertained with true stories from Olympic gold medalists, award-winning artists, business leaders, life-saving physicians, and star comedians who have used the science of small habits to master their craft and vault to the top of their field."""
-            , """Atomic Habits will reshape the way you think about progress and success, and give you the tools and strategies you need to transform your habits--whether you are a team looking to win a championship, an organization hoping to redefine an industry, or simply an individual who wishes to quit smoking, lose weight, reduce stress, or achieve any other goal."""
-        ]
-        , 'authors' :["James Clear"]
-        , 'pages': 319
-        , 'available': 2
-        , 'copies': 2
-    }, 
-
-    {
-        'genres': ["Nonfiction", "Self Help", "Psychology", "Personal Development", "Leadership", "Business", "Communication"]
-        , 'title': "How to Win Friends & Influence People"
-        , 'category': 'Adult' 
-        , 'url': "https://images-na.ssl-images-amazon.com/images/S/compressed.photo.goodreads.com/books/1442726934i/4865.jpg"
-        , 'description': [
-            """You can go after the job you want...and get it! You can take the job you have...and improve it! You can take any situation you're in...and make it work for you!"""
-        , """Since its release in 1936, How to Win Friends and Influence People has sold more than 30 million copies. Dale Carnegie's first book is a timeless bestseller, packed with rock-solid advice that has carried thousands of now famous people up the ladder of success in their business and personal lives."""
-        , """As relevant as ever before, Dale Carnegie's principles endure, and will help you achieve your maximum potential in the complex and competitive modern age."""
-        , """Learn the six ways to make people like you, the twelve ways to win people to your way of thinking, and the nine ways to change people without arousing resentment."""
-        ]
-        , 'authors' :["Dale Carnegie"]
-        , 'pages': 288
-        , 'available': 1
-        , 'copies': 1
-    }, 
-
-    {
-        'genres': ["Nonfiction", "Self Help", "Psychology", "Personal Development", "Business", "Communication"]
-        , 'title': "Never Split the Difference: Negotiating as if Your Life Depended on It"
-        , 'category': 'Adult' 
-        , 'url': "https://images-na.ssl-images-amazon.com/images/S/compressed.photo.goodreads.com/books/1680014152i/123857637.jpg"
-        , 'description': [
-            """A former FBI hostage negotiator offers a new, field-tested approach to negotiating - effective in any situation. """
-            ,"""After a stint policing the rough streets of Kansas City, Missouri, Chris Voss joined the FBI, where his career as a kidnapping negotiator brought him face-to-face with bank robbers, gang leaders, and terrorists. Never Split the Difference takes you inside his world of high-stakes negotiations, revealing the nine key principles that helped Voss and his colleagues succeed when it mattered the most - when people's lives were at stake."""
-            , """Rooted in the real-life experiences of an intelligence professional at the top of his game, Never Split the Difference will give you the competitive edge in any discussion. """
-        ]
-        , 'authors' :["Chris Voss", "Tahl Raz"]
-        , 'pages': 274
-        , 'available': 1
-        , 'copies': 1
-        }
-]
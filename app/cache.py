@@ -0,0 +1,161 @@
+import hashlib
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, g, request, session, make_response
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+
+# rendered catalog pages kept per worker, and for how many seconds at most
+PAGE_CACHE_SIZE = 512
+PAGE_CACHE_TTL = 300
+
+# what the post_button forms of a page rendered for page_cache carry instead of their CSRF
+# token and idempotency key; cached_page fills in fresh ones for every response
+_SLOT_PREFIX = f"form-slot-{uuid.uuid4().hex}"
+CSRF_TOKEN_SLOT = f"{_SLOT_PREFIX}-csrf"
+IDEMPOTENCY_KEY_SLOT = f"{_SLOT_PREFIX}-key"
+
+
+class TTLCache:
+    #bounded in-process cache: least recently used entries are evicted once maxsize
+    #is reached and every entry expires ttl seconds after it was stored.
+    #safe to share between the threads of one worker
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return entry[0] if entry else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+
+# (endpoint, path, viewer) -> (catalog version, rendered body)
+page_cache = TTLCache(maxsize=PAGE_CACHE_SIZE, ttl=PAGE_CACHE_TTL)
+
+
+def form_csrf_token():
+    #template helper for post_button: the CSRF token, or its slot on a page being cached
+    return CSRF_TOKEN_SLOT if g.get('form_slots') else generate_csrf()
+
+
+def fill_form_slots(body):
+    #a cached page's body with this response's CSRF token and a new key for every form
+    if _SLOT_PREFIX.encode() not in body:
+        return body
+    body = body.replace(CSRF_TOKEN_SLOT.encode(), generate_csrf().encode())
+    return re.sub(re.escape(IDEMPOTENCY_KEY_SLOT.encode()), lambda _: uuid.uuid4().hex.encode(), body)
+
+
+def page_ttl():
+    #how long a page may stay in page_cache: PAGE_CACHE_TTL, and never as long as a
+    #CSRF token stays valid
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    return min(PAGE_CACHE_TTL, limit // 2) if limit else PAGE_CACHE_TTL
+
+
+def viewer_key():
+    #what a cached page depends on besides the catalog: '' for anonymous viewers. members'
+    #pages carry loan buttons and the nav badge with their open and overdue loans, which
+    #the overdue sweep and the archiver change too
+    if not current_user.is_authenticated:
+        return ''
+    viewer = (current_user.get_id(),)
+    if current_user.email != 'admin@lib.sg':
+        from app.model import member_stats
+        stats = member_stats()
+        viewer += (stats.active, stats.overdue)
+    return viewer
+
+
+def cached_page(view):
+    #serves a GET page from page_cache while the catalog version it was rendered at is
+    #still current, and answers anonymous revalidations with 304 without rendering anything.
+    #members' pages carry loan forms with one-time idempotency keys, so they are filled in
+    #afresh for every response and never kept by the browser.
+    #pages with pending flash messages are always rendered fresh. works for async views too
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method != 'GET' or session.get('_flashes'):
+            return current_app.ensure_sync(view)(*args, **kwargs)
+        from app.model import CatalogState
+
+        version, updated_at = CatalogState.current()
+        key = (request.endpoint, request.full_path, viewer_key())
+        member = bool(key[2])
+        etag = hashlib.sha1(repr((version, key)).encode()).hexdigest()[:20]
+
+        not_modified = not member and etag in request.if_none_match
+        if not member and not request.if_none_match and request.if_modified_since and updated_at:
+            not_modified = updated_at.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None)
+        if not_modified:
+            response = make_response('', 304)
+        else:
+            cached = page_cache.get(key)
+            if cached and cached[0] == version:
+                response = make_response(fill_form_slots(cached[1]))
+            else:
+                # the version was read from the primary; a lagging secondary could render an
+                # older catalog that would then be cached and etagged as this version
+                g.render_on_primary = True
+                # a streamed page is rendered after this returns and never cached
+                g.form_slots = not current_app.config['STREAM_TEMPLATES']
+                response = make_response(current_app.ensure_sync(view)(*args, **kwargs))
+                g.form_slots = False
+                if response.is_streamed:
+                    return response
+                body = response.get_data()
+                response.set_data(fill_form_slots(body))
+                if response.status_code != 200 or session.get('_flashes'):
+                    return response
+                page_cache.set(key, (version, body), ttl=page_ttl())
+
+        if member:
+            response.cache_control.no_store = True
+            return response
+        response.set_etag(etag)
+        if updated_at:
+            response.last_modified = updated_at
+        # browsers keep the page but must revalidate, which is cheap thanks to the etag
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+        return response
+    return wrapper
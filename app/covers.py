@@ -0,0 +1,241 @@
+import hashlib
+import io
+import ipaddress
+import logging
+import os
+import re
+import socket
+import tempfile
+import threading
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, wait
+from bson import ObjectId
+from bson.errors import InvalidId
+from flask import abort, redirect, request, send_file, url_for
+
+try:
+    from PIL import Image
+except ImportError:  # without Pillow covers are cached as fetched, in one size
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# pre-sized covers by width in px: thumb for the loans table (50px at 2x), card for the catalog
+COVER_SIZES = {'thumb': 100, 'card': 400}
+# covers are requested with ?v=<content hash>, so a given url never changes
+COVER_MAX_AGE = 365 * 24 * 3600
+FETCH_TIMEOUT = 10
+MAX_COVER_BYTES = 10 * 1024 * 1024
+
+_MIMETYPES = ((b'\xff\xd8\xff', 'image/jpeg'), (b'\x89PNG', 'image/png'), (b'GIF8', 'image/gif'),
+              (b'RIFF', 'image/webp'))
+_HASH = re.compile(r'^[0-9a-f]{24}$')
+
+
+def check_url(url, allow_private=False):
+    #raises ValueError unless url is http(s) on a public address. book urls come from
+    #add_book and imported files, and the fetched bytes are served back from /covers
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError(f"cover url must be http or https: {url!r}")
+    if allow_private:
+        return
+    for *_, address in socket.getaddrinfo(parts.hostname, parts.port, proto=socket.IPPROTO_TCP):
+        if not ipaddress.ip_address(address[0]).is_global:
+            raise ValueError(f"cover host {parts.hostname} is not a public address")
+
+
+class CheckedRedirects(urllib.request.HTTPRedirectHandler):
+    #follows a redirect only to a url check_url accepts
+
+    def __init__(self, allow_private):
+        self.allow_private = allow_private
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        check_url(newurl, self.allow_private)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+def http_opener(allow_private=False):
+    #like urllib.request.build_opener but without the file:, ftp: and data: handlers
+    opener = urllib.request.OpenerDirector()
+    for handler in (urllib.request.ProxyHandler(), urllib.request.UnknownHandler(), urllib.request.HTTPHandler(),
+                    urllib.request.HTTPSHandler(), urllib.request.HTTPDefaultErrorHandler(),
+                    urllib.request.HTTPErrorProcessor(), CheckedRedirects(allow_private)):
+        opener.add_handler(handler)
+    return opener
+
+
+class CoverStore:
+    #cover files on disk under content-hash names, <hash>-<size>, shared by every book
+    #with the same image. fetching and resizing run on a small background pool
+
+    def __init__(self):
+        self.directory = None
+        self.allow_private = False
+        self._pool = None
+
+    def init_app(self, app):
+        self.directory = app.config['COVER_DIR']
+        self.allow_private = app.config['COVER_FETCH_PRIVATE_HOSTS']
+        os.makedirs(self.directory, exist_ok=True)
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=app.config['COVER_WORKERS'], thread_name_prefix='covers')
+
+    def path(self, digest, size):
+        return os.path.join(self.directory, f"{digest}-{size}")
+
+    def schedule(self, books):
+        #queues every book whose cover is missing or was fetched from another url;
+        #returns the futures so a command line caller can wait for them. the catalog
+        #content version is bumped once, after the last of them is done
+        books = [book for book in books if book.url and book.cover_source != book.url]
+        batch = CoverBatch(len(books))
+        return [self._pool.submit(self._fetch_logged, book.id, book.url, batch) for book in books]
+
+    def _fetch_logged(self, book_id, url, batch):
+        digest = None
+        try:
+            digest = self.fetch(book_id, url)
+            return digest
+        except Exception as e:
+            logger.warning("could not fetch cover %s for book %s: %s", url, book_id, e)
+            raise
+        finally:
+            batch.done(stored=digest is not None)
+
+    def fetch(self, book_id, url):
+        #downloads one cover, writes the normalized original and every size, then points
+        #the book at them. returns the content hash, or None when the book's url changed
+        #meanwhile. the catalog content version is left to the caller (see CoverBatch)
+        from app.model import Book
+
+        check_url(url, self.allow_private)
+        source = urllib.request.Request(url, headers={'User-Agent': 'sg-library-covers'})
+        with http_opener(self.allow_private).open(source, timeout=FETCH_TIMEOUT) as response:
+            data = response.read(MAX_COVER_BYTES + 1)
+        if len(data) > MAX_COVER_BYTES:
+            raise ValueError(f"cover is larger than {MAX_COVER_BYTES} bytes")
+
+        digest = hashlib.sha256(data).hexdigest()[:24]
+        for size, body in render_sizes(data).items():
+            self._write(self.path(digest, size), body)
+        # matching on url skips books whose url changed while the cover was being fetched
+        if Book.objects(id=book_id, url=url).update_one(set__cover=digest, set__cover_source=url):
+            return digest
+        return None
+
+    @staticmethod
+    def _write(path, body):
+        #written to a temporary name first so a half-written file is never served
+        if os.path.exists(path):
+            return
+        descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(descriptor, 'wb') as stream:
+            stream.write(body)
+        os.replace(temporary, path)
+
+
+class CoverBatch:
+    #the covers of one schedule() call. every content bump rebuilds the catalog snapshot
+    #and empties the page cache in every worker, so an import that fetches thousands of
+    #covers bumps once when the last one is done instead of once per cover
+
+    def __init__(self, pending):
+        self.pending = pending
+        self.stored = 0
+        self._lock = threading.Lock()
+
+    def done(self, stored):
+        #called as each fetch ends, so the future of the last one is done after the bump
+        with self._lock:
+            self.pending -= 1
+            self.stored += stored
+            last = self.pending == 0 and self.stored
+        if last:
+            from app.model import CatalogState
+            CatalogState.bump()
+
+
+def render_sizes(data):
+    #{'original': bytes, 'thumb': bytes, ...} as JPEG, or just the original bytes without Pillow
+    if Image is None:
+        return {'original': data}
+    image = Image.open(io.BytesIO(data))
+    image = image.convert('RGB')
+    sizes = {'original': image}
+    for size, width in COVER_SIZES.items():
+        resized = image.copy()
+        resized.thumbnail((width, width * 4), Image.LANCZOS)
+        sizes[size] = resized
+    rendered = {}
+    for size, picture in sizes.items():
+        out = io.BytesIO()
+        picture.save(out, 'JPEG', quality=85, optimize=True, progressive=True)
+        rendered[size] = out.getvalue()
+    return rendered
+
+
+def _mimetype(path):
+    with open(path, 'rb') as stream:
+        head = stream.read(4)
+    return next((mimetype for magic, mimetype in _MIMETYPES if head.startswith(magic)),
+                'application/octet-stream')
+
+
+store = CoverStore()
+
+
+def cover_url(book, size='card'):
+    #template helper: the cached cover when there is one, the origin url until then
+    if getattr(book, 'cover', None):
+        return url_for('cover', book_id=str(book.id), size=size, v=book.cover)
+    return book.url
+
+
+def serve_cover(book_id, size):
+    if size != 'original' and size not in COVER_SIZES:
+        abort(404)
+    # the content hash in ?v= names the files, so the common case needs no query
+    digest = request.args.get('v', '')
+    if not _HASH.match(digest):
+        from app.model import Book
+        try:
+            book = Book.objects(id=ObjectId(book_id)).only('cover', 'url').first()
+        except InvalidId:
+            abort(404)
+        if not book:
+            abort(404)
+        if not book.cover:
+            return redirect(book.url) if book.url else abort(404)
+        digest = book.cover
+
+    path = store.path(digest, size)
+    if not os.path.exists(path):
+        # stored without Pillow: every size is the original
+        path = store.path(digest, 'original')
+        if not os.path.exists(path):
+            abort(404)
+    versioned = request.args.get('v') == digest
+    response = send_file(path, mimetype=_mimetype(path), max_age=COVER_MAX_AGE if versioned else 3600)
+    response.cache_control.public = True
+    if versioned:
+        response.cache_control.immutable = True
+    return response
+
+
+def init_covers(app):
+    app.config.setdefault('COVER_DIR', os.path.join(app.instance_path, 'covers'))
+    app.config.setdefault('COVER_WORKERS', 4)
+    app.config.setdefault('COVER_FETCH_PRIVATE_HOSTS', False)
+    store.init_app(app)
+    app.add_url_rule('/covers/<book_id>/<size>', 'cover', serve_cover)
+    app.add_template_global(cover_url)
+
+
+def wait_for(futures):
+    #(fetched, failed) once every queued fetch finished
+    wait(futures)
+    failed = sum(1 for future in futures if future.exception())
+    return len(futures) - failed, failed
@@ -0,0 +1,58 @@
+import time
+import uuid
+from functools import wraps
+from flask import Response, current_app, flash, g, redirect, request, session
+from flask_login import current_user
+from app.cache import IDEMPOTENCY_KEY_SLOT
+from app.model import IdempotencyKey
+
+# how long a retry waits for the first request with its key to finish before getting a 409
+PENDING_WAIT = 2.0
+PENDING_POLL = 0.05
+
+
+def idempotency_key():
+    #template helper: a fresh key for one form, see the post_button macro in _forms.html.
+    #a page rendered for the page cache gets a slot instead (see cache.fill_form_slots)
+    if g.get('form_slots'):
+        return IDEMPOTENCY_KEY_SLOT
+    return uuid.uuid4().hex
+
+
+def idempotent(view):
+    #runs a POST view at most once per idempotency key (form field idempotency_key or an
+    #Idempotency-Key header) and member. repeats of the request, e.g. a double click or a
+    #retry after a slow response, get the first outcome again without touching the loan.
+    #the views redirect and flash, so that is what is recorded. works for async views too
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.form.get('idempotency_key') or request.headers.get('Idempotency-Key')
+        if not key:
+            return current_app.ensure_sync(view)(*args, **kwargs)
+        scope = f"{current_user.get_id()}:{request.path}:{key[:64]}"
+
+        outcome = IdempotencyKey.claim(scope)
+        deadline = time.monotonic() + PENDING_WAIT
+        while outcome == IdempotencyKey.PENDING and time.monotonic() < deadline:
+            time.sleep(PENDING_POLL)
+            outcome = IdempotencyKey.outcome(scope) or IdempotencyKey.PENDING
+        if outcome == IdempotencyKey.PENDING:
+            return Response("This request is still being processed.", 409, {'Retry-After': '1'},
+                            mimetype='text/plain')
+        if outcome is not None:
+            for category, message in outcome['flashes']:
+                flash(message, category)
+            return redirect(outcome['location'])
+
+        flashed = len(session.get('_flashes', []))
+        try:
+            response = current_app.make_response(current_app.ensure_sync(view)(*args, **kwargs))
+        except Exception:
+            IdempotencyKey.release(scope)
+            raise
+        if response.status_code in (301, 302, 303) and response.location:
+            IdempotencyKey.finish(scope, response.location, session.get('_flashes', [])[flashed:])
+        else:
+            IdempotencyKey.release(scope)
+        return response
+    return wrapper
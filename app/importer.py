@@ -0,0 +1,88 @@
+import csv
+import json
+import os
+from mongoengine.errors import ValidationError
+from app.model import Book
+
+# fields given as several values; in CSV files they are separated by '|'
+LIST_FIELDS = ('authors', 'genres', 'description')
+INT_FIELDS = ('copies', 'available', 'pages')
+# the library's starting catalog, what `flask import-books` loads without a path
+SEED_CATALOG = os.path.join(os.path.dirname(__file__), 'data', 'books.jsonl')
+# rejected rows kept with their reason; past this only the count grows
+MAX_REPORTED_REJECTS = 20
+
+
+def read_jsonl(stream):
+    #yields (line number, record) one line at a time; bad JSON is yielded as the error text
+    for line_no, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_no, json.loads(line)
+        except ValueError as e:
+            yield line_no, f"invalid JSON: {e}"
+
+
+def read_csv(stream):
+    for line_no, row in enumerate(csv.DictReader(stream), start=2):
+        record = {key: value for key, value in row.items() if key and value not in (None, '')}
+        for field in LIST_FIELDS:
+            if field in record:
+                record[field] = [part.strip() for part in record[field].split('|') if part.strip()]
+        yield line_no, record
+
+
+def to_book(record):
+    #turns one raw record into a validated Book; raises ValueError with the reason
+    if not isinstance(record, dict):
+        raise ValueError(record if isinstance(record, str) else "record is not an object")
+    fields = {name: record[name] for name in Book._fields if name in record and name != 'id'}
+    try:
+        for name in INT_FIELDS:
+            if name in fields:
+                fields[name] = int(fields[name])
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} is not a number")
+    # new titles start with every copy on the shelf unless told otherwise
+    fields.setdefault('available', fields.get('copies', 0))
+    book = Book(**fields)
+    try:
+        book.validate()
+    except ValidationError as e:
+        raise ValueError(str(e))
+    return book
+
+
+def import_books(rows, batch_size=1000):
+    #validates and upserts (line number, record) pairs a batch at a time, so memory
+    #use does not depend on the size of the input. returns counters and the first
+    #MAX_REPORTED_REJECTS rejected rows as (line number, reason)
+    stats = {'read': 0, 'inserted': 0, 'updated': 0, 'rejected': 0, 'rejects': []}
+    batch = []
+    for line_no, record in rows:
+        stats['read'] += 1
+        try:
+            batch.append((line_no, to_book(record)))
+        except ValueError as e:
+            _reject(stats, line_no, str(e))
+        if len(batch) >= batch_size:
+            _write_batch(batch, stats)
+            batch = []
+    if batch:
+        _write_batch(batch, stats)
+    return stats
+
+
+def _write_batch(batch, stats):
+    inserted, updated, failed = Book.bulk_upsert([book for _, book in batch])
+    stats['inserted'] += inserted
+    stats['updated'] += updated
+    for position, reason in failed:
+        _reject(stats, batch[position][0], reason)
+
+
+def _reject(stats, line_no, reason):
+    stats['rejected'] += 1
+    if len(stats['rejects']) < MAX_REPORTED_REJECTS:
+        stats['rejects'].append((line_no, reason))
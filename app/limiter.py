@@ -0,0 +1,196 @@
+import math
+import threading
+import time
+from flask import Response, g, request
+from flask_login import current_user
+from app.cache import TTLCache
+from app.metrics import metrics
+
+# the write routes under admission control, and the methods that count as a write
+# (GET on add_book only renders the form)
+LIMITED_ROUTES = {
+    'main.make_loan': None,
+    'main.renew_loan': None,
+    'main.return_loan': None,
+    'main.add_book': {'POST'},
+}
+# members whose token bucket is remembered; an evicted member starts again with a full bucket
+MEMBER_BUCKETS = 10000
+
+
+class RouteGate:
+    #at most `concurrency` requests of one route run at once; up to `queue` more wait for
+    #a slot for at most `timeout` seconds. anything beyond that is turned away at once,
+    #so a checkout spike cannot tie up every worker thread and starve the read routes
+
+    def __init__(self, concurrency, queue, timeout):
+        self.concurrency = concurrency
+        self.queue = queue
+        self.timeout = timeout
+        self.running = 0
+        self.waiting = 0
+        self._slots = threading.Condition()
+
+    def enter(self):
+        #True once the request holds a slot, False when it was shed
+        with self._slots:
+            if self.running < self.concurrency:
+                self.running += 1
+                return True
+            if self.waiting >= self.queue:
+                return False
+            self.waiting += 1
+            try:
+                if not self._slots.wait_for(lambda: self.running < self.concurrency, self.timeout):
+                    return False
+                self.running += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def leave(self):
+        with self._slots:
+            self.running -= 1
+            self._slots.notify()
+
+
+class ThreadBudget:
+    #worker threads the limited routes may hold at once, running or waiting for a slot.
+    #the rest of the worker's threads always stay free for the read routes, so a request
+    #that would take the last of them is shed instead of blocking
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            if self.used >= self.limit:
+                return False
+            self.used += 1
+            return True
+
+    def give_back(self):
+        with self._lock:
+            self.used -= 1
+
+
+class TokenBucket:
+    #`rate` tokens a second up to `burst`; each write takes one
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        #0 when a token was taken, otherwise the seconds until the next one
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class AdmissionControl:
+    #per-worker admission control for LIMITED_ROUTES: a token bucket per member, then the
+    #worker's ThreadBudget, then a RouteGate per route. rejected requests get 429 (member
+    #over their rate) or 503 (no thread to spare, or route saturated) with a Retry-After
+    #header, before the view or any query runs
+
+    def __init__(self):
+        self.enabled = False
+        self.buckets_enabled = True
+        self.threads = ThreadBudget(0)
+        self.gates = {}
+        self._buckets = TTLCache(maxsize=MEMBER_BUCKETS, ttl=3600)
+        self._bucket_lock = threading.Lock()
+
+    def init_app(self, app):
+        self.enabled = app.config['ADMISSION_CONTROL']
+        self.rate = app.config['MEMBER_WRITE_RATE']
+        self.burst = app.config['MEMBER_WRITE_BURST']
+        self.retry_after = app.config['WRITE_RETRY_AFTER']
+        self.size(app.config, app.config['WORKER_THREADS'])
+        app.before_request(self.admit)
+        app.teardown_request(self.release)
+
+    def size(self, config, worker_threads):
+        #sets the limits for a worker with worker_threads request threads: READ_THREADS of
+        #them are kept for the read routes, and no route may run or queue more requests
+        #than the write routes may hold together
+        self.threads = ThreadBudget(max(1, worker_threads - config['READ_THREADS']))
+        concurrency = min(config['WRITE_CONCURRENCY'], self.threads.limit)
+        queue = min(config['WRITE_QUEUE'], self.threads.limit - concurrency)
+        self.gates = {endpoint: RouteGate(concurrency, queue, config['WRITE_QUEUE_TIMEOUT_MS'] / 1000)
+                      for endpoint in LIMITED_ROUTES}
+
+    def _bucket(self, member):
+        with self._bucket_lock:
+            bucket = self._buckets.get(member)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+                self._buckets.set(member, bucket)
+            return bucket
+
+    def admit(self):
+        endpoint = request.endpoint
+        if not self.enabled or endpoint not in LIMITED_ROUTES:
+            return None
+        methods = LIMITED_ROUTES[endpoint]
+        if methods is not None and request.method not in methods:
+            return None
+        labels = [('endpoint', endpoint)]
+
+        if self.buckets_enabled and self.rate:
+            member = current_user.get_id() if current_user.is_authenticated else request.remote_addr
+            wait = self._bucket(member).take()
+            if wait:
+                metrics.inc('library_admission_rejected_total', labels + [('reason', 'member_rate')])
+                return self._reject(429, "You are doing that too often, please try again shortly.", wait)
+
+        if not self.threads.take():
+            metrics.inc('library_admission_rejected_total', labels + [('reason', 'threads')])
+            return self._reject(503, "The library is busy, please try again shortly.", self.retry_after)
+        started = time.perf_counter()
+        if not self.gates[endpoint].enter():
+            self.threads.give_back()
+            metrics.inc('library_admission_rejected_total', labels + [('reason', 'overloaded')])
+            return self._reject(503, "The library is busy, please try again shortly.", self.retry_after)
+        g.admission_gate = self.gates[endpoint]
+        metrics.inc('library_admission_admitted_total', labels)
+        metrics.observe('library_admission_wait_seconds', labels, time.perf_counter() - started)
+        return None
+
+    def release(self, exc=None):
+        gate = g.pop('admission_gate', None)
+        if gate is not None:
+            gate.leave()
+            self.threads.give_back()
+
+    @staticmethod
+    def _reject(status, message, retry_after):
+        return Response(message, status, {'Retry-After': str(max(1, math.ceil(retry_after)))},
+                        mimetype='text/plain')
+
+    def gauges(self):
+        #current per-route state for /metrics
+        rows = [
+            (('library_admission_threads_used', ()), self.threads.used),
+            (('library_admission_threads_limit', ()), self.threads.limit),
+        ]
+        for endpoint, gate in sorted(self.gates.items()):
+            labels = (('endpoint', endpoint),)
+            rows.append((('library_admission_running', labels), gate.running))
+            rows.append((('library_admission_waiting', labels), gate.waiting))
+            rows.append((('library_admission_concurrency_limit', labels), gate.concurrency))
+        return rows
+
+
+limiter = AdmissionControl()
@@ -0,0 +1,230 @@
+import contextvars
+import hmac
+import ipaddress
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from flask import Response, abort, g, has_request_context, request
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+# filter/query keys of the commands we can describe as a query shape
+_SPEC_KEYS = {
+    'find': 'filter', 'count': 'query', 'findAndModify': 'query', 'distinct': 'query',
+}
+
+
+def _shape(value):
+    #the structure of a filter with every value replaced by '?'
+    if isinstance(value, dict):
+        return {key: _shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_shape(value[0])] if value else []
+    return '?'
+
+
+def query_shape(command_name, command):
+    collection = command.get(command_name)
+    if command_name in _SPEC_KEYS:
+        spec = command.get(_SPEC_KEYS[command_name], {})
+    elif command_name in ('update', 'delete'):
+        statements = command.get('updates' if command_name == 'update' else 'deletes') or [{}]
+        spec = statements[0].get('q', {})
+    elif command_name == 'aggregate':
+        spec = command.get('pipeline', [])[:1]
+    else:
+        spec = {}
+    return f"{command_name} {collection} {json.dumps(_shape(spec), default=str, sort_keys=True)}"
+
+
+def _label_value(value):
+    #a label value escaped as the Prometheus text format requires
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    #process-wide counters rendered in the Prometheus text format by /metrics.
+    #each worker process keeps its own, so scrape every worker. names ending in _total are
+    #counters, names given to observe() summaries (_sum and _count), anything else gauges
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.summaries = set()
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            self.counters[(name, tuple(labels))] += value
+
+    def observe(self, name, labels=(), value=0):
+        #one observation of a summary: adds value to name_sum and 1 to name_count
+        labels = tuple(labels)
+        with self._lock:
+            self.summaries.add(name)
+            self.counters[(f"{name}_sum", labels)] += value
+            self.counters[(f"{name}_count", labels)] += 1
+
+    def _family(self, name):
+        #(family name, type) of a series
+        for suffix in ('_sum', '_count'):
+            if name.endswith(suffix) and name[:-len(suffix)] in self.summaries:
+                return name[:-len(suffix)], 'summary'
+        return name, 'counter' if name.endswith('_total') else 'gauge'
+
+    def render(self, extra=()):
+        #extra: more ((name, labels), value) rows, e.g. gauges read at scrape time
+        with self._lock:
+            rows = list(self.counters.items())
+            families = defaultdict(list)
+            for (name, labels), value in rows + list(extra):
+                families[self._family(name)].append((name, labels, value))
+        lines = []
+        for (family, kind), samples in sorted(families.items()):
+            lines.append(f"# TYPE {family} {kind}")
+            for name, labels, value in sorted(samples, key=lambda sample: (sample[0], sample[1])):
+                label_text = ','.join(f'{key}="{_label_value(item)}"' for key, item in labels)
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+class CommandTally:
+    #the commands charged to one request
+
+    def __init__(self):
+        self.commands = 0
+        self.duration_ms = 0.0
+        self.pending = {}
+
+
+class CommandMonitor(monitoring.CommandListener):
+    #times every MongoDB command and charges it to the request it ran for. the tally lives in
+    #a context variable: the sync driver publishes command events on the calling thread, and
+    #the async client's tasks start in a copy of the view's context (see aio.AsyncDatabase.run)
+
+    def __init__(self, metrics, slow_command_ms):
+        self.metrics = metrics
+        self.slow_command_ms = slow_command_ms
+        self._tally = contextvars.ContextVar('mongo_command_tally')
+
+    def reset(self):
+        self._tally.set(CommandTally())
+
+    def tally(self):
+        tally = self._tally.get(None)
+        if tally is None:
+            tally = CommandTally()
+            self._tally.set(tally)
+        return tally
+
+    @property
+    def commands(self):
+        return self.tally().commands
+
+    @property
+    def duration_ms(self):
+        return self.tally().duration_ms
+
+    def started(self, event):
+        self.tally().pending[event.request_id] = query_shape(event.command_name, event.command)
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        self.metrics.inc('library_mongo_command_failures_total', [('command', event.command_name)])
+        self._finish(event)
+
+    def _finish(self, event):
+        tally = self.tally()
+        shape = tally.pending.pop(event.request_id, event.command_name)
+        duration_ms = event.duration_micros / 1000
+        tally.commands += 1
+        tally.duration_ms += duration_ms
+        labels = [('command', event.command_name)]
+        self.metrics.inc('library_mongo_commands_total', labels)
+        self.metrics.observe('library_mongo_command_seconds', labels, duration_ms / 1000)
+        if duration_ms >= self.slow_command_ms:
+            self.metrics.inc('library_slow_mongo_commands_total', labels)
+            route = request.endpoint if has_request_context() else None
+            logger.warning("slow mongo command %.1fms route=%s shape=%s", duration_ms, route, shape)
+
+
+metrics = Metrics()
+command_monitor = None
+
+
+def scraper_allowed(config):
+    #whether the current request may read /metrics, see METRICS_ALLOWED_IPS and METRICS_TOKEN
+    token = config['METRICS_TOKEN']
+    if token and request.authorization and request.authorization.type == 'bearer':
+        if hmac.compare_digest(str(request.authorization.token or ''), token):
+            return True
+    allowed = config['METRICS_ALLOWED_IPS']
+    if isinstance(allowed, str):
+        allowed = allowed.split(',')
+    try:
+        address = ipaddress.ip_address(request.remote_addr or '')
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network.strip(), strict=False) for network in allowed if network.strip())
+
+
+def init_metrics(app):
+    #must run before the MongoDB client is created so the command listener is attached
+    global command_monitor
+    app.config.setdefault('SLOW_REQUEST_MS', 500)
+    app.config.setdefault('SLOW_COMMAND_MS', 100)
+    # /metrics answers scrapers from these addresses or networks, and any client sending
+    # Authorization: Bearer METRICS_TOKEN; everyone else gets 403
+    app.config.setdefault('METRICS_ALLOWED_IPS', ['127.0.0.1', '::1'])
+    app.config.setdefault('METRICS_TOKEN', None)
+    if command_monitor is None:
+        # pymongo listeners are process wide, so a second app reuses the first one
+        command_monitor = CommandMonitor(metrics, app.config['SLOW_COMMAND_MS'])
+        monitoring.register(command_monitor)
+    command_monitor.slow_command_ms = app.config['SLOW_COMMAND_MS']
+
+    @app.before_request
+    def start_request_timer():
+        command_monitor.reset()
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        #streamed bodies are rendered after this point, their queries are not included
+        if 'request_started' not in g:
+            return response
+        elapsed_ms = (time.perf_counter() - g.request_started) * 1000
+        endpoint = request.endpoint or 'unknown'
+        commands, db_ms = command_monitor.commands, command_monitor.duration_ms
+        response.headers['Server-Timing'] = (
+            f'db;dur={db_ms:.1f};desc="{commands} mongo commands", app;dur={elapsed_ms:.1f}'
+        )
+        labels = [('endpoint', endpoint)]
+        metrics.inc('library_http_requests_total', labels + [('status', response.status_code)])
+        metrics.observe('library_http_request_seconds', labels, elapsed_ms / 1000)
+        metrics.observe('library_http_request_mongo_commands', labels, commands)
+        if elapsed_ms >= app.config['SLOW_REQUEST_MS']:
+            metrics.inc('library_slow_requests_total', labels)
+            app.logger.warning("slow request %.1fms route=%s path=%s mongo=%d commands/%.1fms",
+                               elapsed_ms, endpoint, request.full_path, commands, db_ms)
+        return response
+
+    def metrics_endpoint():
+        if not scraper_allowed(app.config):
+            abort(403)
+        from app.model import _user_cache
+        from app.cache import page_cache
+        from app.limiter import limiter
+        extra = []
+        for name, cache in (('user', _user_cache), ('page', page_cache)):
+            for key, value in cache.stats().items():
+                suffix = '' if key == 'size' else '_total'
+                extra.append(((f'library_{name}_cache_{key}{suffix}', ()), value))
+        extra.extend(limiter.gauges())
+        return Response(metrics.render(extra), mimetype='text/plain; version=0.0.4')
+
+    app.add_url_rule('/metrics', 'metrics', metrics_endpoint)
@@ -1,10 +1,45 @@
 from datetime import datetime, timedelta
+import asyncio
+import base64
+import json
 import random
+import time
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ReadPreference, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from flask import current_app, g, has_request_context, session
 from flask_wtf import FlaskForm
-from flask_login import UserMixin
+from flask_login import UserMixin, current_user
 from wtforms import StringField, PasswordField, SubmitField, BooleanField, IntegerField, SelectMultipleField, SelectField,TextAreaField
 from wtforms.validators import DataRequired, Email, Length
+from mongoengine import signals
+from mongoengine.errors import NotUniqueError
+from mongoengine.queryset.visitor import Q
 from app import db, login_manager
+from app.cache import TTLCache
+from app import search
+from app import aio
+from app import snapshot
+
+# number of book cards per catalog page
+PAGE_SIZE = 20
+# how many users load_user keeps in memory, and for how many seconds
+USER_CACHE_SIZE = 1024
+USER_CACHE_TTL = 300
+# returned loans stay in the loans collection this many days before they are archived
+ARCHIVE_RETURNED_AFTER_DAYS = 30
+# archived loans are deleted by a TTL index this many days after they were returned
+LOAN_HISTORY_RETENTION_DAYS = 7 * 365
+# seconds the outcome of a loan operation is kept for replaying a retried request
+IDEMPOTENCY_KEY_TTL = 600
+
+# catalog version -> facet groups, so facet counts are computed in memory
+_facet_cache = TTLCache(maxsize=2, ttl=300)
+# email -> User, so authenticated requests do not query users every time
+_user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+# idempotency scope -> outcome, so a retry on the same worker does not query at all
+_outcome_cache = TTLCache(maxsize=4096, ttl=IDEMPOTENCY_KEY_TTL)
 
 class LoginForm(FlaskForm):
     email = StringField(
@@ -96,12 +131,99 @@ class AddBookForm(FlaskForm):
     submit = SubmitField('Add Book')
     add_author = SubmitField('Add Another Author')
 
+# the Book fields loan and return need back from their atomic update
+CIRCULATION_FIELDS = ('available', 'category', 'genres')
+# the Book fields a catalog card renders; list pages load only these, details() the whole book
+CARD_FIELDS = ('title', 'authors', 'category', 'genres', 'pages', 'teaser', 'available', 'url', 'cover')
+
+
+def catalog_read_preference():
+    #CATALOG_READ_PREFERENCE inside requests, except for a member who changed something
+    #in the last PRIMARY_READS_AFTER_WRITE seconds (see read_own_writes) and for pages
+    #rendered into the page cache or under an api etag (see cached_page, api._etag);
+    #primary otherwise
+    if not has_request_context() or session.get('primary_reads_until', 0) > time.time():
+        return ReadPreference.PRIMARY
+    if g.get('render_on_primary'):
+        return ReadPreference.PRIMARY
+    return current_app.config['CATALOG_READ_PREFERENCE']
+
+
+def read_own_writes():
+    #call after a member's write that shows up on catalog pages (loans, returns, new titles)
+    session['primary_reads_until'] = time.time() + current_app.config['PRIMARY_READS_AFTER_WRITE']
+
+
+class BookPage:
+    #one keyset page of books. going forward, books are pulled off the Mongo cursor while
+    #the page is iterated, so a streamed template sends each card as its document arrives.
+    #prev_cursor and next_cursor are only final once the page has been iterated.
+    #a page read from the catalog snapshot comes with its rows and only needs their
+    #availability, which is read in one query when the page is fetched or iterated
+
+    def __init__(self, books, per_page, has_position, backwards=False, rows=None):
+        self._books = books
+        self._per_page = per_page
+        self._has_position = has_position
+        self._backwards = backwards
+        self._rows = rows
+        self._needs_availability = rows is not None
+        self.prev_cursor = None
+        self.next_cursor = None
+
+    async def fetch_async(self):
+        #reads the page up front through the async client; iterating it then does no I/O
+        if self._needs_availability:
+            await Book.fill_availability_async(self._rows)
+            self._needs_availability = False
+        else:
+            self._rows = await aio.db.find(self._books, limit=self._per_page + 1)
+        return self
+
+    def __iter__(self):
+        #fetch one extra row to find out if there is another page in this direction
+        if self._needs_availability:
+            Book.fill_availability(self._rows)
+            self._needs_availability = False
+        rows = self._rows if self._rows is not None else self._books.limit(self._per_page + 1)
+        if self._backwards:
+            #pages before a cursor are read in reverse and have to be flipped first
+            rows = list(rows)
+            has_prev = len(rows) > self._per_page
+            rows = rows[:self._per_page][::-1]
+            if rows:
+                self.prev_cursor = Book.encode_cursor(rows[0].title, rows[0].id) if has_prev else None
+                self.next_cursor = Book.encode_cursor(rows[-1].title, rows[-1].id)
+            yield from rows
+            return
+
+        last = None
+        for count, book in enumerate(rows):
+            if count == self._per_page:
+                self.next_cursor = Book.encode_cursor(last.title, last.id)
+                break
+            if count == 0 and self._has_position:
+                self.prev_cursor = Book.encode_cursor(book.title, book.id)
+            last = book
+            yield book
+
+
 class Book(db.Document):
     
     # Meta class for model configuration
     meta = {
         'collection': 'books',
-        'ordering': ['title'] #descending order
+        'ordering': ['title'], #descending order
+        'indexes': [
+            #details() and make_loan() look books up by title
+            {'fields': ['title'], 'unique': True},
+            #keyset pagination sorts on (title, _id), with or without a category filter
+            ['title', 'id'],
+            ['category', 'title', 'id'],
+            ['genres', 'title', 'id'],
+            #most borrowed titles on the admin dashboard
+            '-times_borrowed',
+        ]
     }
     title = db.StringField(
         max_length=200, 
@@ -134,52 +256,336 @@ class Book(db.Document):
     description = db.ListField(
         db.StringField(),
     )
+    # first and last paragraph of the description, what a catalog card shows. kept in
+    # step with description by clean() and bulk_upsert
+    teaser = db.ListField(
+        db.StringField(),
+    )
     pages = db.IntField(
         min_value=1,
     )
+    # loans ever made for this title, for the most borrowed list
+    times_borrowed = db.IntField(
+        default=0,
+    )
+    # content hash of the locally cached cover (see app/covers.py) and the url it came from
+    cover = db.StringField(
+        max_length=64,
+    )
+    cover_source = db.StringField(
+        max_length=255,
+    )
+
+    def clean(self):
+        #runs on every validate(), so save() and the importer both refresh the teaser
+        self.teaser = Book.make_teaser(self.description)
+
+    @staticmethod
+    def make_teaser(description):
+        description = description or []
+        return description[:1] + description[-1:] if len(description) > 1 else list(description)
 
     def loan_book(self):
-        if self.available > 0:
-            self.available -= 1
-            self.save()
-            return True
-        return False
+        taken = Book.take_copy(self.id)
+        if taken is None:
+            return False
+        self.available = taken.available
+        return True
     
     def return_book(self):
-        if self.available < self.copies:
-            self.available += 1
-            self.save()
-            return True
-        return False
+        returned = Book.give_back_copy(self.id)
+        if returned is None:
+            return False
+        self.available = returned.available
+        return True
+
+    @staticmethod
+    def take_copy(book_id):
+        #single guarded $inc: concurrent checkouts can never push available below zero.
+        #returns the book projected to available, category and genres (what the
+        #circulation rollups need), or None when no copy was left.
+        #raw $inc because mongoengine would validate the -1 against min_value
+        book = (Book.objects(id=book_id, available__gt=0).only(*CIRCULATION_FIELDS)
+                .modify(__raw__={'$inc': {'available': -1, 'times_borrowed': 1}}, new=True))
+        if book is None:
+            return None
+        if book.available == 0:
+            FacetGroup.move(book.category, book.genres, available=False)
+        CatalogState.bump(content=False)
+        return book
+
+    @staticmethod
+    async def take_copy_async(book_id):
+        book = await aio.db.call(
+            Book, 'find_one_and_update', {'_id': book_id, 'available': {'$gt': 0}},
+            {'$inc': {'available': -1, 'times_borrowed': 1}},
+            projection=dict.fromkeys(CIRCULATION_FIELDS, 1), return_document=ReturnDocument.AFTER,
+        )
+        if book is None:
+            return None
+        book = Book._from_son(book)
+        if book.available == 0:
+            await FacetGroup.move_async(book.category, book.genres, available=False)
+        await CatalogState.bump_async(content=False)
+        return book
+
+    @staticmethod
+    def give_back_copy(book_id, undo_loan=False):
+        #same as take_copy the other way round, guarded so available never exceeds copies.
+        #undo_loan also takes back the times_borrowed count of a loan that was never made
+        inc = {'available': 1, 'times_borrowed': -1} if undo_loan else {'available': 1}
+        book = (Book.objects(id=book_id, __raw__={'$expr': {'$lt': ['$available', '$copies']}})
+                .only(*CIRCULATION_FIELDS).modify(__raw__={'$inc': inc}, new=True))
+        if book is None:
+            return None
+        if book.available == 1:
+            FacetGroup.move(book.category, book.genres, available=True)
+        CatalogState.bump(content=False)
+        return book
+
+    @staticmethod
+    async def give_back_copy_async(book_id, undo_loan=False):
+        inc = {'available': 1, 'times_borrowed': -1} if undo_loan else {'available': 1}
+        book = await aio.db.call(
+            Book, 'find_one_and_update', {'_id': book_id, '$expr': {'$lt': ['$available', '$copies']}},
+            {'$inc': inc}, projection=dict.fromkeys(CIRCULATION_FIELDS, 1),
+            return_document=ReturnDocument.AFTER,
+        )
+        if book is None:
+            return None
+        book = Book._from_son(book)
+        if book.available == 1:
+            await FacetGroup.move_async(book.category, book.genres, available=True)
+        await CatalogState.bump_async(content=False)
+        return book
     #static method has access to nothing so no need define instance, self
     #can just call class name directly
 
     @staticmethod
     def get_all_books():
         return Book.objects()
-    
+
+    @staticmethod
+    def catalog():
+        #queryset for catalog browsing reads, which may be served by a secondary
+        return Book.objects.read_preference(catalog_read_preference())
+
+    @staticmethod
+    def cards():
+        #catalog reads for list pages: only what a card renders, no full description
+        return Book.catalog().only(*CARD_FIELDS)
+
+    @staticmethod
+    def get_by_title(title):
+        catalog = snapshot.store.current()
+        if catalog is not None:
+            book = Book.from_snapshot(catalog, title)
+            if book is not None:
+                Book.fill_availability([book])
+            return book
+        return Book.catalog().filter(title=title).first()
+
+    @staticmethod
+    def from_snapshot(catalog, title):
+        #the whole book (without availability) from the catalog snapshot, or None
+        index = catalog.find(title)
+        return Book._from_son(catalog.son(index, details=True)) if index is not None else None
+
+    @staticmethod
+    def _availability_query(books):
+        return Book.catalog().filter(id__in=[book.id for book in books]).only('available')
+
+    @staticmethod
+    def fill_availability(books):
+        #sets the live available count on books read from the catalog snapshot
+        live = {book.id: book.available for book in Book._availability_query(books)}
+        for book in books:
+            book.available = live.get(book.id, 0)
+
+    @staticmethod
+    async def fill_availability_async(books):
+        live = {book.id: book.available for book in await aio.db.find(Book._availability_query(books))}
+        for book in books:
+            book.available = live.get(book.id, 0)
+
+    @staticmethod
+    def encode_cursor(title, book_id):
+        #opaque url-safe token for the (title, id) position of a book
+        raw = json.dumps([title, str(book_id)]).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        #returns (title, ObjectId) or None if the cursor is garbled
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            title, book_id = json.loads(raw)
+            return title, ObjectId(book_id)
+        except (ValueError, TypeError, InvalidId):
+            return None
+
+    @staticmethod
+    def keyset_filter(position, backwards=False):
+        #rows strictly after (or before) a decoded cursor in (title, _id) order.
+        #the plain title bound keeps the index scan tight, the $or breaks ties on _id
+        title, book_id = position
+        if backwards:
+            return Q(title__lte=title) & (Q(title__lt=title) | Q(id__lt=book_id))
+        return Q(title__gte=title) & (Q(title__gt=title) | Q(id__gt=book_id))
+
+    @staticmethod
+    def get_books_page(category="All", after=None, before=None, per_page=PAGE_SIZE, genres=(), available_only=False):
+        #keyset pagination on (title, _id) so every page costs one indexed range scan,
+        #no matter how deep into the catalog it is. genres must all be on a book.
+        #with CATALOG_SNAPSHOT the same rows come from the snapshot, unless the filter
+        #is on availability, which the snapshot does not hold
+        position = Book.decode_cursor(before or after) if (before or after) else None
+        catalog = None if available_only else snapshot.store.current()
+        if catalog is not None:
+            backwards = bool(position and before)
+            indexes = catalog.scan(category, genres, position, backwards, limit=per_page + 1)
+            rows = [Book._from_son(catalog.son(index)) for index in indexes]
+            return BookPage(None, per_page, position is not None, backwards, rows=rows)
+
+        books = Book.cards() if category == "All" else Book.cards().filter(category=category)
+        if genres:
+            books = books.filter(genres__all=list(genres))
+        if available_only:
+            books = books.filter(available__gt=0)
+        if position and before:
+            books = books.filter(Book.keyset_filter(position, backwards=True)).order_by('-title', '-id')
+        elif position:
+            books = books.filter(Book.keyset_filter(position)).order_by('title', 'id')
+        else:
+            books = books.order_by('title', 'id')
+
+        return BookPage(books, per_page, position is not None, backwards=bool(position and before))
+
+    @staticmethod
+    async def get_books_page_async(category="All", after=None, before=None, per_page=PAGE_SIZE, genres=(),
+                                   available_only=False):
+        return await Book.get_books_page(category, after, before, per_page, genres, available_only).fetch_async()
+
+    @staticmethod
+    async def get_by_title_async(title):
+        catalog = snapshot.store.current()
+        if catalog is not None:
+            book = Book.from_snapshot(catalog, title)
+            if book is not None:
+                await Book.fill_availability_async([book])
+            return book
+        return await aio.db.first(Book.catalog().filter(title=title))
+
     @staticmethod
-    #use this method to initialize the db with books from books.py
-    def init_books(all_books):
-        #if no books in db, add all from books.py
-        if Book.objects.count() == 0:
-            for book_data in all_books:
-                # Check if book already exists by title
-                if not Book.objects(title=book_data['title']).first():
-                    # Create and save the book
-                    Book(
-                        title=book_data['title'],
-                        authors=book_data.get('authors', []),
-                        category=book_data.get('category', ''),
-                        genres=book_data.get('genres', []),
-                        copies=book_data.get('copies', 0),
-                        available=book_data.get('available', 0),
-                        url=book_data.get('url', ''),
-                        description=book_data.get('description', []),
-                        pages=book_data.get('pages', 0)
-                    ).save()
+    def search(query, limit=PAGE_SIZE):
+        #ranked full-text search over title, authors, genres and description.
+        #returns [(book, score)], best match first
+        hits = search.ensure_built().search(query, limit)
+        books = {book.id: book for book in Book.cards().filter(id__in=[book_id for book_id, _ in hits])}
+        return [(books[book_id], score) for book_id, score in hits if book_id in books]
+
+    @staticmethod
+    def fill_teasers(batch_size=1000):
+        #writes the teaser of every book that has none yet. returns how many were filled
+        filled, requests = 0, []
+        for book in Book.objects(teaser__exists=False).only('description').as_pymongo().no_cache():
+            requests.append(UpdateOne({'_id': book['_id']},
+                                      {'$set': {'teaser': Book.make_teaser(book.get('description'))}}))
+            if len(requests) == batch_size:
+                filled += Book._get_collection().bulk_write(requests, ordered=False).modified_count
+                requests = []
+        if requests:
+            filled += Book._get_collection().bulk_write(requests, ordered=False).modified_count
+        if filled:
+            CatalogState.bump()
+        return filled
+
+    @staticmethod
+    #used by flask import-books to write one batch of validated books
+    def bulk_upsert(books):
+        #one unordered bulk write keyed on title. descriptive fields are refreshed on every
+        #import; copies/available/times_borrowed are only set for new titles so a re-import
+        #never resets live circulation. returns (inserted, modified, [(position in batch, reason)]);
+        #titles that matched but had nothing to change are in neither count
+        requests = []
+        for book in books:
+            doc = book.to_mongo().to_dict()
+            doc.pop('_id', None)
+            # books built in code (e.g. by bench) may not have been validated
+            doc['teaser'] = Book.make_teaser(book.description)
+            inventory = {name: doc.pop(name) for name in ('copies', 'available', 'times_borrowed') if name in doc}
+            requests.append(UpdateOne({'title': book.title}, {'$set': doc, '$setOnInsert': inventory}, upsert=True))
+        if not requests:
+            return 0, 0, []
+        try:
+            result = Book._get_collection().bulk_write(requests, ordered=False).bulk_api_result
+        except BulkWriteError as e:
+            result = e.details
+        failed = [(error['index'], error['errmsg']) for error in result.get('writeErrors', [])]
+        if result['nUpserted'] or result['nModified']:
+            CatalogState.bump(search=True)
+        return result['nUpserted'], result['nModified'], failed
                     
       
+class CatalogState(db.Document):
+    #one document whose version changes whenever anything shown on a catalog page
+    #changes (new titles, availability), so rendered pages know when they are stale.
+    #content_version skips availability changes, for the catalog snapshot (app/snapshot.py);
+    #search_version only moves with the fields the search index holds (app/search.py)
+    meta = {
+        'collection': 'catalog_state'
+    }
+    id = db.StringField(primary_key=True, default='catalog')
+    version = db.IntField(default=0)
+    content_version = db.IntField(default=0)
+    search_version = db.IntField(default=0)
+    updated_at = db.DateTimeField()
+
+    @staticmethod
+    def current():
+        #(version, last change time); (0, None) before the first change
+        state = CatalogState._get_collection().find_one({'_id': 'catalog'})
+        if not state:
+            return 0, None
+        return state.get('version', 0), state.get('updated_at')
+
+    @staticmethod
+    def content_version():
+        state = CatalogState._get_collection().find_one({'_id': 'catalog'}, {'content_version': 1})
+        return state.get('content_version', 0) if state else 0
+
+    @staticmethod
+    def search_version():
+        state = CatalogState._get_collection().find_one({'_id': 'catalog'}, {'search_version': 1})
+        return state.get('search_version', 0) if state else 0
+
+    @staticmethod
+    def bump(content=True, search=False):
+        #content=False for changes that only touch availability, search=True for changes to
+        #titles, authors, genres or descriptions. with search, returns the new search_version
+        update = CatalogState._bump_update(content, search)
+        if not search:
+            CatalogState._get_collection().update_one({'_id': 'catalog'}, update, upsert=True)
+            return None
+        state = CatalogState._get_collection().find_one_and_update(
+            {'_id': 'catalog'}, update, projection={'search_version': 1}, upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return state['search_version']
+
+    @staticmethod
+    async def bump_async(content=True):
+        await aio.db.call(CatalogState, 'update_one', {'_id': 'catalog'}, CatalogState._bump_update(content),
+                          upsert=True)
+
+    @staticmethod
+    def _bump_update(content, search=False):
+        inc = {'version': 1, 'content_version': 1} if content or search else {'version': 1}
+        if search:
+            inc['search_version'] = 1
+        return {'$inc': inc, '$set': {'updated_at': datetime.utcnow()}}
+
+
 class User(db.Document, UserMixin):
     meta = {
         'collection': 'users'
@@ -207,6 +613,21 @@ class User(db.Document, UserMixin):
     @staticmethod
     def get_user_by_email(email):
         return User.objects(email=email).first()
+
+    @staticmethod
+    def get_cached_user(email):
+        #served from _user_cache when possible; unknown emails are never cached
+        user = _user_cache.get(email)
+        if user is None:
+            user = User.get_user_by_email(email)
+            if user:
+                _user_cache.set(email, user)
+        return user
+
+    @staticmethod
+    def invalidate_cache(email):
+        #call after changing a user through a queryset update, which skips the save signals
+        _user_cache.pop(email)
     
     @staticmethod
     def create_user(name, email, password_hash):
@@ -225,9 +646,337 @@ class User(db.Document, UserMixin):
             return user
         return None
               
+class FacetGroup(db.Document):
+    #facet index for catalog browsing: how many titles share a (category, exact genre set,
+    #available now) combination. every facet count under any filter is a sum over these
+    #groups, and there are only as many as distinct genre sets, however big the catalog.
+    #kept current by add_book and by take_copy/give_back_copy when availability crosses 0
+    meta = {
+        'collection': 'facet_groups'
+    }
+    id = db.StringField(primary_key=True) # "Adult|Fantasy,Fiction|1"
+    category = db.StringField()
+    genres = db.ListField(db.StringField())
+    available = db.BooleanField()
+    titles = db.IntField(default=0)
+
+    @staticmethod
+    def _group(category, genres, available):
+        genres = sorted(set(genres or []))
+        key = f"{category}|{','.join(genres)}|{int(bool(available))}"
+        return key, {'category': category, 'genres': genres, 'available': bool(available)}
+
+    @staticmethod
+    def _update(category, genres, available, delta):
+        key, fields = FacetGroup._group(category, genres, available)
+        return UpdateOne({'_id': key}, {'$inc': {'titles': delta}, '$setOnInsert': fields}, upsert=True)
+
+    @staticmethod
+    def add(category, genres, available, delta=1):
+        FacetGroup._get_collection().bulk_write([FacetGroup._update(category, genres, available, delta)])
+
+    @staticmethod
+    def move(category, genres, available):
+        #a title became available (or unavailable): one group loses it, the other gains it
+        FacetGroup._get_collection().bulk_write(FacetGroup._move_requests(category, genres, available), ordered=False)
+
+    @staticmethod
+    async def move_async(category, genres, available):
+        await aio.db.call(FacetGroup, 'bulk_write', FacetGroup._move_requests(category, genres, available), ordered=False)
+
+    @staticmethod
+    def _move_requests(category, genres, available):
+        return [FacetGroup._update(category, genres, not available, -1),
+                FacetGroup._update(category, genres, available, 1)]
+
+    @staticmethod
+    def rebuild():
+        #recomputes every group from the books collection, e.g. after an import
+        groups = {}
+        for row in Book.objects.aggregate([{'$group': {
+            '_id': {'category': '$category', 'genres': '$genres', 'available': {'$gt': ['$available', 0]}},
+            'titles': {'$sum': 1},
+        }}]):
+            # the same genres in another order land in the same group
+            key, fields = FacetGroup._group(row['_id'].get('category'), row['_id'].get('genres'),
+                                            row['_id']['available'])
+            groups.setdefault(key, dict(fields, _id=key, titles=0))['titles'] += row['titles']
+        if groups:
+            FacetGroup._get_collection().bulk_write(
+                [ReplaceOne({'_id': key}, group, upsert=True) for key, group in groups.items()], ordered=False
+            )
+        FacetGroup.objects(id__nin=list(groups)).delete()
+        # the counts are not part of the catalog snapshot
+        CatalogState.bump(content=False)
+        return len(groups)
+
+    @staticmethod
+    def load():
+        #[(category, genre set, available, titles)] for the current catalog version
+        version, _ = CatalogState.current()
+        cached = _facet_cache.get(version)
+        if cached is None:
+            cached = [(group['category'], frozenset(group['genres']), group['available'], group['titles'])
+                      for group in FacetGroup.objects(titles__gt=0).as_pymongo()]
+            if not cached and Book.objects.only('id').first():
+                # first use after an upgrade, or the groups were dropped
+                FacetGroup.rebuild()
+                return FacetGroup.load()
+            _facet_cache.set(version, cached)
+        return cached
+
+    @staticmethod
+    def counts(category="All", genres=(), available_only=False):
+        #facet counts for a browse selection: total matching titles, and for every option
+        #how many titles the selection would have with that option applied. genres combine
+        #with AND, like the genre filter of get_books_page
+        selected = frozenset(genres)
+        result = {'total': 0, 'categories': {}, 'genres': {}, 'available': 0}
+        for group_category, group_genres, available, titles in FacetGroup.load():
+            if not selected <= group_genres:
+                continue
+            in_category = category == "All" or group_category == category
+            if available or not available_only:
+                result['categories'][group_category] = result['categories'].get(group_category, 0) + titles
+                if in_category:
+                    result['total'] += titles
+                    for genre in group_genres:
+                        result['genres'][genre] = result['genres'].get(genre, 0) + titles
+            if available and in_category:
+                result['available'] += titles
+        result['categories']['All'] = sum(result['categories'].values())
+        return result
+
+
+class CirculationStats(db.Document):
+    #one rollup document per category and per genre, kept current by add_book, create_loan
+    #and return_loan, so the admin dashboard reads O(genres) documents instead of
+    #scanning loans and books. reconcile() rebuilds them from the books collection
+    meta = {
+        'collection': 'circulation_stats',
+        'ordering': ['kind', 'name']
+    }
+    id = db.StringField(primary_key=True) # "category:Adult", "genre:Fantasy"
+    kind = db.StringField(choices=('category', 'genre'))
+    name = db.StringField()
+    titles = db.IntField(default=0)
+    copies = db.IntField(default=0)
+    on_loan = db.IntField(default=0)
+    loans_total = db.IntField(default=0)
+
+    @property
+    def utilization(self):
+        return self.on_loan / self.copies if self.copies else 0
+
+    @staticmethod
+    def record(category, genres, **deltas):
+        #adds deltas to the book's category rollup and to each of its genre rollups
+        #in one unordered bulk write
+        CirculationStats._get_collection().bulk_write(
+            CirculationStats._record_requests(category, genres, deltas), ordered=False
+        )
+
+    @staticmethod
+    async def record_async(category, genres, **deltas):
+        await aio.db.call(CirculationStats, 'bulk_write',
+                          CirculationStats._record_requests(category, genres, deltas), ordered=False)
+
+    @staticmethod
+    def _record_requests(category, genres, deltas):
+        keys = [('category', category)] + [('genre', genre) for genre in set(genres or [])]
+        return [
+            UpdateOne(
+                {'_id': f"{kind}:{name}"},
+                {'$inc': deltas, '$setOnInsert': {'kind': kind, 'name': name}},
+                upsert=True,
+            )
+            for kind, name in keys if name
+        ]
+
+    @staticmethod
+    def reconcile(recount_loans=False):
+        #rebuilds every rollup with an aggregation over books. with recount_loans the
+        #per-title times_borrowed counters are first recounted from the loans collection
+        if recount_loans:
+            # archived loans were made too
+            counts = {}
+            for document in (Loan, LoanHistory):
+                for row in document.objects.aggregate([{'$group': {'_id': '$book', 'count': {'$sum': 1}}}]):
+                    counts[row['_id']] = counts.get(row['_id'], 0) + row['count']
+            requests = [UpdateOne({'_id': book_id}, {'$set': {'times_borrowed': count}})
+                        for book_id, count in counts.items()]
+            Book.objects(times_borrowed__ne=0).update(set__times_borrowed=0)
+            if requests:
+                Book._get_collection().bulk_write(requests, ordered=False)
+
+        totals = {
+            '_id': None,
+            'titles': {'$sum': 1},
+            'copies': {'$sum': '$copies'},
+            'on_loan': {'$sum': {'$subtract': ['$copies', '$available']}},
+            'loans_total': {'$sum': {'$ifNull': ['$times_borrowed', 0]}},
+        }
+        rollups = []
+        for kind, pipeline in (
+            ('category', [{'$group': dict(totals, _id='$category')}]),
+            ('genre', [{'$unwind': '$genres'}, {'$group': dict(totals, _id='$genres')}]),
+        ):
+            for row in Book.objects.aggregate(pipeline):
+                name = row.pop('_id')
+                if name:
+                    rollups.append(dict(row, _id=f"{kind}:{name}", kind=kind, name=name))
+        if rollups:
+            CirculationStats._get_collection().bulk_write(
+                [ReplaceOne({'_id': rollup['_id']}, rollup, upsert=True) for rollup in rollups],
+                ordered=False,
+            )
+        CirculationStats.objects(id__nin=[rollup['_id'] for rollup in rollups]).delete()
+        return len(rollups)
+
+
+class MemberStats(db.Document):
+    #per-member loan counters, stored next to users instead of on them so that
+    #updating a counter never invalidates the cached User. create_loan, renew_loan,
+    #return_loan, delete_loan and the archiver keep them current with $inc; recount and
+    #reconcile rebuild them from the loans and loan_history collections
+    meta = {
+        'collection': 'member_stats'
+    }
+    id = db.ObjectIdField(primary_key=True) # the member's User id
+    active = db.IntField(default=0)    # open loans not yet due
+    overdue = db.IntField(default=0)   # open loans past their due date
+    loans = db.IntField(default=0)     # loans listed on view_loans (open or returned, not archived)
+    # loans on record, archived ones included (a member deleting a loan removes it), and
+    # their renewals
+    borrowed = db.IntField(default=0)
+    renewals = db.IntField(default=0)
+    # set once the counters have been counted from the loans; members from before the
+    # counters existed are recounted on first use
+    counted = db.BooleanField(default=False)
+
+    @property
+    def on_loan(self):
+        return self.active + self.overdue
+
+    @staticmethod
+    def add(member_id, **deltas):
+        #atomically adds deltas to the member's counters, creating the document if needed
+        MemberStats.objects(id=member_id).update_one(
+            upsert=True, **{f'inc__{name}': delta for name, delta in deltas.items()}
+        )
+
+    @staticmethod
+    async def add_async(member_id, **deltas):
+        await aio.db.call(MemberStats, 'update_one', {'_id': member_id}, {'$inc': deltas}, upsert=True)
+
+    @staticmethod
+    def get_for(member_id):
+        #one read by _id
+        return MemberStats.objects(id=member_id, counted=True).first() or MemberStats.recount(member_id)
+
+    @staticmethod
+    async def get_for_async(member_id):
+        stats = await aio.db.first(MemberStats.objects(id=member_id, counted=True))
+        # the recount happens once per member, so it stays on the blocking client
+        return stats or MemberStats.recount(member_id)
+
+    @staticmethod
+    def _count(match):
+        #{member id: counters} from the loans and the archive, for the members matching match
+        counters = {}
+        for document in (Loan, LoanHistory):
+            current = document is Loan
+            for row in document.objects.aggregate([{'$match': match}, {'$group': {
+                '_id': '$member',
+                'active': {'$sum': {'$cond': [{'$eq': ['$status', 'active']}, 1, 0]}} if current else {'$sum': 0},
+                'overdue': {'$sum': {'$cond': [{'$eq': ['$status', 'overdue']}, 1, 0]}} if current else {'$sum': 0},
+                'loans': {'$sum': 1 if current else 0},
+                'borrowed': {'$sum': 1},
+                'renewals': {'$sum': {'$ifNull': ['$renew_count', 0]}},
+            }}]):
+                member_id = row.pop('_id')
+                totals = counters.setdefault(member_id, dict.fromkeys(row, 0))
+                for name, value in row.items():
+                    totals[name] += value
+        return counters
+
+    @staticmethod
+    def _counted(member_id, counters):
+        return dict(counters, _id=member_id, counted=True)
+
+    @staticmethod
+    def recount(member_id):
+        #rebuilds one member's counters from their loans (both collections are indexed by member)
+        counters = MemberStats._count({'member': member_id}).get(member_id) or dict(
+            active=0, overdue=0, loans=0, borrowed=0, renewals=0)
+        document = MemberStats._counted(member_id, counters)
+        MemberStats._get_collection().replace_one({'_id': member_id}, document, upsert=True)
+        return MemberStats._from_son(document)
+
+    @staticmethod
+    def reconcile():
+        #rebuilds the counters of every member with loans and zeroes the rest. returns how
+        #many members have loans
+        counters = MemberStats._count({})
+        if counters:
+            MemberStats._get_collection().bulk_write([
+                ReplaceOne({'_id': member_id}, MemberStats._counted(member_id, totals), upsert=True)
+                for member_id, totals in counters.items()
+            ], ordered=False)
+        MemberStats.objects(id__nin=list(counters)).update(
+            set__active=0, set__overdue=0, set__loans=0, set__borrowed=0, set__renewals=0, set__counted=True)
+        return len(counters)
+
+    @staticmethod
+    def refresh_open():
+        #recounts active and overdue loans per member from the status index, touching only
+        #open loans; the sweep flips loans in bulk without knowing whose they are
+        counts = {}
+        for row in Loan.objects(status__in=('active', 'overdue')).aggregate([
+            {'$group': {'_id': {'member': '$member', 'status': '$status'}, 'count': {'$sum': 1}}},
+        ]):
+            counts.setdefault(row['_id']['member'], {'active': 0, 'overdue': 0})[row['_id']['status']] = row['count']
+        if counts:
+            MemberStats._get_collection().bulk_write([
+                UpdateOne({'_id': member_id}, {'$set': open_loans}, upsert=True)
+                for member_id, open_loans in counts.items()
+            ], ordered=False)
+        MemberStats.objects(Q(id__nin=list(counts)) & (Q(active__ne=0) | Q(overdue__ne=0))).update(
+            set__active=0, set__overdue=0)
+
+
+def member_stats():
+    #template helper for the nav badge: the signed-in member's counters, read once per request
+    if 'member_stats' not in g:
+        g.member_stats = MemberStats.get_for(current_user.id) if current_user.is_authenticated else None
+    return g.member_stats
+
+
+LOAN_STATUSES = ('active', 'overdue', 'returned')
+
+
 class Loan(db.Document):
     meta = {
         'collection': 'loans',
+        'indexes': [
+            #view_loans lists a member's loans newest first
+            ['member', '-borrow_date'],
+            #the overdue sweep and overdue reports
+            ['status', 'due_date'],
+            #a member can hold at most one open loan per book
+            {
+                'fields': ['member', 'book'],
+                'unique': True,
+                'name': 'open_loans',
+                'partialFilterExpression': {'returned': False},
+            },
+            #the archiver picks returned loans by return date
+            {
+                'fields': ['return_date'],
+                'name': 'returned_loans',
+                'partialFilterExpression': {'returned': True},
+            },
+        ]
     }
     member = db.ReferenceField(User, required=True)
     book = db.ReferenceField(Book, required=True)
@@ -235,30 +984,182 @@ class Loan(db.Document):
     return_date = db.DateTimeField()
     due_date = db.DateTimeField(required=True)
     renew_count = db.IntField(default=0)
+    #mirrors return_date, kept as a plain flag so open loans can have a partial index
+    returned = db.BooleanField(default=False)
+    #set by create/return and moved from active to overdue by Loan.sweep_overdue
+    status = db.StringField(choices=LOAN_STATUSES, default='active')
     
+    @property
+    def book_id(self):
+        #id of the loaned book without dereferencing it
+        return self._data['book'].id
+
+    @property
+    def member_id(self):
+        return self._data['member'].id
+
     @staticmethod
     def create_loan(member, book):
-        # Check if member already has unreturned loan for this book
-        existing = Loan.objects(member=member, book=book, return_date=None).first()
-        if existing:
+        # Reserve a copy first; fails without touching loans if none is left
+        taken = Book.take_copy(book.id)
+        if taken is None:
             return None
-        
-        if book.available > 0:
-            # Generate random borrow date 10-20 days before today
-            days_ago = random.randint(10, 20)
-            borrow_date = datetime.now() - timedelta(days=days_ago)
-            due_date = borrow_date + timedelta(days=14)
-
-            loan = Loan(member=member, book=book, borrow_date=borrow_date, due_date=due_date)
-            loan.save()
-            book.loan_book()
-            return loan
-        return None
+        book.available = taken.available
+
+        # Generate random borrow date 10-20 days before today
+        days_ago = random.randint(10, 20)
+        borrow_date = datetime.now() - timedelta(days=days_ago)
+        due_date = borrow_date + timedelta(days=14)
+
+        status = 'overdue' if due_date < datetime.now() else 'active'
+        loan = Loan(member=member, book=book, borrow_date=borrow_date, due_date=due_date, status=status)
+        try:
+            loan.save(force_insert=True)
+        except NotUniqueError:
+            # the open_loans index says the member already has this book, hand the copy back
+            Book.give_back_copy(book.id, undo_loan=True)
+            book.available += 1
+            return None
+        CirculationStats.record(taken.category, taken.genres, on_loan=1, loans_total=1)
+        MemberStats.add(member.id, loans=1, borrowed=1, **{status: 1})
+        return loan
+
+    @staticmethod
+    async def create_loan_async(member, book):
+        #create_loan on the async client; the rollup and member counter updates
+        #after the insert are independent and run concurrently
+        taken = await Book.take_copy_async(book.id)
+        if taken is None:
+            return None
+        book.available = taken.available
+
+        days_ago = random.randint(10, 20)
+        borrow_date = datetime.now() - timedelta(days=days_ago)
+        due_date = borrow_date + timedelta(days=14)
+
+        status = 'overdue' if due_date < datetime.now() else 'active'
+        loan = Loan(member=member, book=book, borrow_date=borrow_date, due_date=due_date, status=status)
+        loan.validate()
+        try:
+            loan.id = (await aio.db.call(Loan, 'insert_one', loan.to_mongo())).inserted_id
+        except DuplicateKeyError:
+            await Book.give_back_copy_async(book.id, undo_loan=True)
+            book.available += 1
+            return None
+        await asyncio.gather(
+            CirculationStats.record_async(taken.category, taken.genres, on_loan=1, loans_total=1),
+            MemberStats.add_async(member.id, loans=1, borrowed=1, **{status: 1}),
+        )
+        return loan
     
     @staticmethod
     def get_user_loans(member):
-        return Loan.objects(member=member).order_by('-borrow_date')
+        #two queries no matter how many loans: the loans, then one $in fetch for their
+        #books projected down to the fields view_loans renders
+        return Loan._attach_books(list(Loan.objects(member=member).order_by('-borrow_date')))
+
+    @staticmethod
+    def iter_user_loans(member, chunk_size=100):
+        #same as get_user_loans but lazy, for streamed pages: loans are read off the cursor
+        #and their books resolved with one $in fetch per chunk_size loans
+        chunk = []
+        for loan in Loan.objects(member=member).order_by('-borrow_date'):
+            chunk.append(loan)
+            if len(chunk) >= chunk_size:
+                yield from Loan._attach_books(chunk)
+                chunk = []
+        yield from Loan._attach_books(chunk)
+
+    @staticmethod
+    async def get_user_loans_async(member):
+        return await Loan._attach_books_async(
+            await aio.db.find(Loan.objects(member=member).order_by('-borrow_date'))
+        )
+
+    @staticmethod
+    def _attach_books(loans):
+        book_ids = {loan.book_id for loan in loans}
+        if not book_ids:
+            return loans
+        books = {book.id: book for book in Book.objects(id__in=book_ids).only('title', 'authors', 'url', 'cover')}
+        return Loan._attach(loans, books)
+
+    @staticmethod
+    async def _attach_books_async(loans):
+        book_ids = {loan.book_id for loan in loans}
+        if not book_ids:
+            return loans
+        books = await aio.db.find(Book.objects(id__in=book_ids).only('title', 'authors', 'url', 'cover'))
+        return Loan._attach(loans, {book.id: book for book in books})
+
+    @staticmethod
+    def _attach(loans, books):
+        for loan in loans:
+            if loan.book_id in books:
+                loan.book = books[loan.book_id]
+        return loans
     
+    @staticmethod
+    def get_overdue_loans():
+        return Loan.objects(status='overdue').order_by('due_date')
+
+    @staticmethod
+    def sweep_overdue(now=None):
+        #one indexed multi-update moves every active loan past its due date to overdue,
+        #then the per-member overdue counts are recounted. returns how many loans flipped
+        now = now or datetime.now()
+        Loan.backfill_status(now)
+        flipped = Loan.objects(status='active', due_date__lt=now).update(set__status='overdue')
+        MemberStats.refresh_open()
+        return flipped
+
+    @staticmethod
+    def backfill_status(now=None):
+        #loans saved before the status field existed have no returned flag either;
+        #return_date tells whether they were returned, due_date whether an open one is
+        #overdue. returns how many loans were filled in
+        now = now or datetime.now()
+        filled = Loan.objects(status=None, return_date__ne=None).update(set__status='returned', set__returned=True)
+        filled += Loan.objects(status=None, return_date=None, due_date__lt=now).update(
+            set__status='overdue', set__returned=False)
+        filled += Loan.objects(status=None, return_date=None).update(set__status='active', set__returned=False)
+        return filled
+
+    @staticmethod
+    def archive_returned(older_than_days=ARCHIVE_RETURNED_AFTER_DAYS, batch_size=1000, now=None):
+        #moves loans returned more than older_than_days ago to loan_history a batch at a time.
+        #a batch is copied (upserted by _id) before it is deleted, so a run that dies in
+        #between only copies it again next time. loans are deleted one by one, like
+        #delete_loan does, so a loan the member deleted meanwhile is neither counted twice
+        #nor kept in the archive. returns how many loans were moved
+        cutoff = (now or datetime.now()) - timedelta(days=older_than_days)
+        history = LoanHistory._get_collection()
+        loans = Loan._get_collection()
+        moved = 0
+        while True:
+            batch = list(Loan.objects(returned=True, return_date__lt=cutoff).limit(batch_size).as_pymongo())
+            if not batch:
+                return moved
+            archived_at = datetime.now()
+            history.bulk_write([
+                ReplaceOne({'_id': loan['_id']}, LoanHistory.from_loan(loan, archived_at), upsert=True)
+                for loan in batch
+            ], ordered=False)
+            archived, gone = {}, []
+            for loan in batch:
+                if loans.delete_one({'_id': loan['_id'], 'returned': True}).deleted_count:
+                    archived[loan['member']] = archived.get(loan['member'], 0) + 1
+                else:
+                    gone.append(loan['_id'])
+            if gone:
+                history.delete_many({'_id': {'$in': gone}})
+            if archived:
+                MemberStats._get_collection().bulk_write([
+                    UpdateOne({'_id': member_id}, {'$inc': {'loans': -count}})
+                    for member_id, count in archived.items()
+                ], ordered=False)
+            moved += sum(archived.values())
+
     @staticmethod
     def get_loan_by_id(loan_id):
         return Loan.objects(id=loan_id).first()
@@ -270,14 +1171,21 @@ class Loan(db.Document):
             new_borrow_date = self.borrow_date + timedelta(days=days_forward)
             
             # Cannot be later than today
-            if new_borrow_date > datetime.now():
-                new_borrow_date = datetime.now()
-            
-            self.borrow_date = new_borrow_date
-            self.due_date = new_borrow_date + timedelta(days=14)
-            self.renew_count += 1
-            self.save()
-            return True
+            now = datetime.now()
+            if new_borrow_date > now:
+                new_borrow_date = now
+            due_date = new_borrow_date + timedelta(days=14)
+
+            # Matching on the renew count we read means a repeated request cannot renew twice
+            renewed = Loan.objects(
+                id=self.id, status='active', renew_count=self.renew_count, due_date__gte=now
+            ).update_one(set__borrow_date=new_borrow_date, set__due_date=due_date, inc__renew_count=1)
+            if renewed:
+                self.borrow_date = new_borrow_date
+                self.due_date = due_date
+                self.renew_count += 1
+                MemberStats.add(self.member_id, renewals=1)
+                return True
         return False
     
     def return_loan(self):
@@ -289,31 +1197,247 @@ class Loan(db.Document):
             # Cannot be later than today
             if return_date > datetime.now():
                 return_date = datetime.now()
-            
+
+            # Only the request that flips the loan gives the copy back; the old status
+            # tells which of the member's open loan counters goes down
+            previous = Loan.objects(id=self.id, returned=False).only('status').modify(
+                set__return_date=return_date, set__returned=True, set__status='returned'
+            )
+            if not previous:
+                return False
             self.return_date = return_date
-            self.save()
-            self.book.return_book()
+            self.returned = True
+            self.status = 'returned'
+            returned = Book.give_back_copy(self.book_id)
+            if returned:
+                CirculationStats.record(returned.category, returned.genres, on_loan=-1)
+            if previous.status in ('active', 'overdue'):
+                MemberStats.add(self.member_id, **{previous.status: -1})
             return True
         return False
     
     def delete_loan(self):
         if self.return_date:
-            self.delete()
+            # only the request that removes the loan takes it off the member's counts
+            if Loan.objects(id=self.id, returned=True).delete():
+                MemberStats.add(self.member_id, loans=-1, borrowed=-1, renewals=-self.renew_count)
             return True
         return False
     
     def is_overdue(self):
-        return datetime.now() > self.due_date and not self.return_date
+        # the sweep may not have caught up with a loan that fell due since its last run
+        return self.status == 'overdue' or (self.status == 'active' and datetime.now() > self.due_date)
     
     def can_renew(self):
-        return self.renew_count < 2 and not self.is_overdue() and not self.return_date
+        return self.status == 'active' and self.renew_count < 2 and not self.is_overdue()
     
     def can_return(self):
         return not self.return_date
 
 
+class LoanHistory(db.Document):
+    #returned loans moved out of the hot loans collection by Loan.archive_returned, keyed by
+    #the loan's id. period is the month of return ('2025-08') for reporting and clean-up;
+    #documents expire LOAN_HISTORY_RETENTION_DAYS after the return
+    meta = {
+        'collection': 'loan_history',
+        'indexes': [
+            #view_loans pages through a member's history, latest return first
+            ['member', '-return_date', '-id'],
+            'period',
+            {'fields': ['return_date'], 'expireAfterSeconds': LOAN_HISTORY_RETENTION_DAYS * 24 * 3600},
+        ]
+    }
+    member = db.ReferenceField(User, required=True)
+    book = db.ReferenceField(Book, required=True)
+    borrow_date = db.DateTimeField(required=True)
+    due_date = db.DateTimeField(required=True)
+    return_date = db.DateTimeField(required=True)
+    renew_count = db.IntField(default=0)
+    status = db.StringField(default='returned')
+    period = db.StringField(max_length=7)
+    archived_at = db.DateTimeField()
+
+    @property
+    def book_id(self):
+        return self._data['book'].id
+
+    @staticmethod
+    def from_loan(loan, archived_at):
+        #history document for a raw returned loan document
+        history = {name: value for name, value in loan.items() if name != 'returned'}
+        history.update(status='returned', period=loan['return_date'].strftime('%Y-%m'), archived_at=archived_at)
+        return history
+
+    @staticmethod
+    def encode_cursor(return_date, loan_id):
+        raw = json.dumps([return_date.isoformat(), str(loan_id)]).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            return_date, loan_id = json.loads(raw)
+            return datetime.fromisoformat(return_date), ObjectId(loan_id)
+        except (ValueError, TypeError, InvalidId):
+            return None
+
+    @staticmethod
+    def history_query(member, before=None, per_page=PAGE_SIZE):
+        #one keyset page of a member's archived loans on (return_date, _id), newest first,
+        #plus one extra row to tell whether there is an older page
+        loans = LoanHistory.objects(member=member)
+        position = LoanHistory.decode_cursor(before) if before else None
+        if position:
+            return_date, loan_id = position
+            loans = loans.filter(Q(return_date__lte=return_date) & (Q(return_date__lt=return_date) | Q(id__lt=loan_id)))
+        return loans.order_by('-return_date', '-id').limit(per_page + 1)
+
+    @staticmethod
+    def get_page(member, before=None, per_page=PAGE_SIZE):
+        #(archived loans with their books, cursor of the next older page or None)
+        rows = list(LoanHistory.history_query(member, before, per_page))
+        return Loan._attach_books(rows[:per_page]), LoanHistory._next_cursor(rows, per_page)
+
+    @staticmethod
+    async def get_page_async(member, before=None, per_page=PAGE_SIZE):
+        rows = await aio.db.find(LoanHistory.history_query(member, before, per_page))
+        return await Loan._attach_books_async(rows[:per_page]), LoanHistory._next_cursor(rows, per_page)
+
+    @staticmethod
+    def _next_cursor(rows, per_page):
+        if len(rows) <= per_page:
+            return None
+        last = rows[per_page - 1]
+        return LoanHistory.encode_cursor(last.return_date, last.id)
+
+
+class IdempotencyKey(db.Document):
+    #the outcome of one loan operation (where it redirected and what it flashed), keyed by
+    #"<user id>:<path>:<idempotency key>". the first request claims the key by inserting
+    #it, so a retry on any worker replays the outcome instead of writing again. expires
+    #IDEMPOTENCY_KEY_TTL seconds after the request
+    meta = {
+        'collection': 'idempotency_keys',
+        'indexes': [
+            {'fields': ['created_at'], 'expireAfterSeconds': IDEMPOTENCY_KEY_TTL},
+        ]
+    }
+    id = db.StringField(primary_key=True)
+    done = db.BooleanField(default=False)
+    location = db.StringField()
+    flashes = db.ListField(db.ListField(db.StringField()))
+    created_at = db.DateTimeField()
+
+    # claim() result while the first request is still running
+    PENDING = 'pending'
+
+    @staticmethod
+    def claim(scope):
+        #None when this request now owns the key; otherwise the stored outcome
+        #{'location', 'flashes'}, or PENDING
+        outcome = IdempotencyKey.outcome(scope, local_only=True)
+        if outcome is not None:
+            return outcome
+        try:
+            IdempotencyKey._get_collection().insert_one({'_id': scope, 'done': False, 'created_at': datetime.utcnow()})
+            return None
+        except DuplicateKeyError:
+            return IdempotencyKey.outcome(scope) or IdempotencyKey.PENDING
+
+    @staticmethod
+    def outcome(scope, local_only=False):
+        outcome = _outcome_cache.get(scope)
+        if outcome is not None or local_only:
+            return outcome
+        record = IdempotencyKey._get_collection().find_one({'_id': scope, 'done': True})
+        if record is None:
+            return None
+        outcome = {'location': record.get('location'), 'flashes': record.get('flashes', [])}
+        _outcome_cache.set(scope, outcome)
+        return outcome
+
+    @staticmethod
+    def finish(scope, location, flashes):
+        outcome = {'location': location, 'flashes': [list(flash) for flash in flashes]}
+        IdempotencyKey._get_collection().update_one({'_id': scope}, {'$set': dict(outcome, done=True)})
+        _outcome_cache.set(scope, outcome)
+
+    @staticmethod
+    def release(scope):
+        #the request failed before it had an outcome; a retry may run it again
+        IdempotencyKey._get_collection().delete_one({'_id': scope, 'done': False})
+
+
+#drop cached users whenever they are created, saved or deleted
+def _invalidate_cached_user(sender, document, **kwargs):
+    User.invalidate_cache(document.email)
+
+signals.post_save.connect(_invalidate_cached_user, sender=User)
+signals.post_delete.connect(_invalidate_cached_user, sender=User)
+
+
+#query shapes the routes depend on; every one of them must be served by an index
+def indexed_queries():
+    any_id = ObjectId()
+    return [
+        ("book by title", Book.objects(title="")),
+        ("catalog page", Book.objects.order_by('title', 'id').limit(PAGE_SIZE + 1)),
+        ("catalog page after cursor", Book.objects(Book.keyset_filter(("", any_id)))
+            .order_by('title', 'id').limit(PAGE_SIZE + 1)),
+        ("category page", Book.objects(category="").order_by('title', 'id').limit(PAGE_SIZE + 1)),
+        ("genre page", Book.objects(genres__all=[""]).order_by('title', 'id').limit(PAGE_SIZE + 1)),
+        ("open loan check", Loan.objects(member=any_id, book=any_id, returned=False)),
+        ("member loans", Loan.objects(member=any_id).order_by('-borrow_date')),
+        ("overdue sweep", Loan.objects(status='active', due_date__lt=datetime.now())),
+        ("returned loans to archive", Loan.objects(returned=True, return_date__lt=datetime.now())),
+        ("member loan history", LoanHistory.history_query(any_id)),
+        ("user by email", User.objects(email="")),
+        ("most borrowed titles", Book.objects.order_by('-times_borrowed').limit(10)),
+    ]
+
+
+def _has_collscan(plan):
+    #walk an explain() plan tree looking for a full collection scan stage
+    if isinstance(plan, dict):
+        if plan.get('stage') == 'COLLSCAN':
+            return True
+        return any(_has_collscan(value) for value in plan.values())
+    if isinstance(plan, list):
+        return any(_has_collscan(value) for value in plan)
+    return False
+
+
+def check_indexes(create=True):
+    #create (or only compare) the declared indexes and explain every hot query shape.
+    #returns (missing, collscans): lists of problems, both empty when all is well
+    if create:
+        #loans saved before the status field existed need it for renewals and the sweep,
+        #and the member counters recounted from it
+        if Loan.backfill_status():
+            MemberStats.refresh_open()
+        #loans saved before the returned flag existed need it for the open_loans index
+        Loan.objects(returned=None, return_date=None).update(set__returned=False)
+        Loan.objects(returned=None, return_date__ne=None).update(set__returned=True)
+        #books saved before catalog cards read the teaser need it filled in
+        Book.fill_teasers()
+    missing = []
+    for document in (Book, User, Loan, LoanHistory, MemberStats, CirculationStats, FacetGroup, IdempotencyKey):
+        if create:
+            document.ensure_indexes()
+        for index in document.compare_indexes()['missing']:
+            missing.append(f"{document._get_collection_name()}: {index}")
+
+    collscans = []
+    for name, queryset in indexed_queries():
+        if _has_collscan(queryset.explain().get('queryPlanner', {}).get('winningPlan')):
+            collscans.append(name)
+    return missing, collscans
+
+
 #used by flask-login to reload the user object from the user stored in the session
 #check if valid user, if valid return user object
 @login_manager.user_loader
 def load_user(user_id):
-    return User.get_user_by_email(user_id)
\ No newline at end of file
+    return User.get_cached_user(user_id)
\ No newline at end of file
@@ -0,0 +1,171 @@
+import bisect
+import logging
+import math
+import re
+import threading
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# how much a term counts depending on the field it was found in
+FIELD_WEIGHTS = {'title': 3.0, 'authors': 2.0, 'genres': 1.5, 'description': 1.0}
+# a prefix hit scores lower than the whole word, and expands to at most this many terms
+PREFIX_FACTOR = 0.5
+MAX_PREFIX_TERMS = 50
+
+TOKEN_RE = re.compile(r"[^\W_]+")
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+class SearchIndex:
+    #in-process inverted index over the catalog: term -> {book id: field-weighted term
+    #frequency}, plus a sorted vocabulary so prefixes are found with a binary search.
+    #version is the catalog search version it was built from, None until it is built
+
+    def __init__(self):
+        self.version = None
+        self._postings = defaultdict(dict)
+        self._terms = []
+        self._doc_terms = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._doc_terms)
+
+    def add(self, book_id, title='', authors=(), genres=(), description=()):
+        fields = {
+            'title': [title or ''],
+            'authors': authors or [],
+            'genres': genres or [],
+            'description': description or [],
+        }
+        weights = defaultdict(float)
+        for field, values in fields.items():
+            for value in values:
+                for term in tokenize(value):
+                    weights[term] += FIELD_WEIGHTS[field]
+        with self._lock:
+            self.remove(book_id)
+            for term, weight in weights.items():
+                if term not in self._postings:
+                    bisect.insort(self._terms, term)
+                self._postings[term][book_id] = weight
+            self._doc_terms[book_id] = list(weights)
+
+    def add_book(self, book):
+        self.add(book.id, book.title, book.authors, book.genres, book.description)
+
+    def remove(self, book_id):
+        with self._lock:
+            for term in self._doc_terms.pop(book_id, ()):
+                postings = self._postings[term]
+                postings.pop(book_id, None)
+                if not postings:
+                    del self._postings[term]
+                    del self._terms[bisect.bisect_left(self._terms, term)]
+
+    def clear(self):
+        with self._lock:
+            self._postings.clear()
+            self._terms.clear()
+            self._doc_terms.clear()
+            self.version = None
+
+    def _expand(self, token):
+        #the token itself plus up to MAX_PREFIX_TERMS longer terms starting with it
+        start = bisect.bisect_left(self._terms, token)
+        matches = []
+        for term in self._terms[start:start + MAX_PREFIX_TERMS + 1]:
+            if not term.startswith(token):
+                break
+            matches.append((term, 1.0 if term == token else PREFIX_FACTOR))
+        return matches
+
+    def search(self, query, limit=20):
+        #every query word must match (whole word or prefix); results are ranked by
+        #sum of log term frequency * idf over the matched terms. returns [(book id, score)]
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        with self._lock:
+            total = len(self._doc_terms)
+            scores = None
+            for token in dict.fromkeys(tokens):
+                token_scores = defaultdict(float)
+                for term, factor in self._expand(token):
+                    postings = self._postings[term]
+                    idf = math.log(1 + total / len(postings))
+                    for book_id, weight in postings.items():
+                        token_scores[book_id] += factor * idf * (1 + math.log(weight))
+                if scores is None:
+                    scores = token_scores
+                else:
+                    scores = {book_id: score + token_scores[book_id]
+                              for book_id, score in scores.items() if book_id in token_scores}
+                if not scores:
+                    return []
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], str(item[0])))
+        return ranked[:limit]
+
+
+# the catalog index shared by every request of this worker; replaced by a new one when
+# an indexed field changes (CatalogState.search_version, which covers and availability
+# leave alone)
+catalog_index = SearchIndex()
+_build_lock = threading.Lock()
+_rebuilding = None
+
+
+def build_index(version):
+    #a new index of every book, streaming only the indexed fields
+    from app.model import Book
+    index = SearchIndex()
+    for book in Book.objects.only('title', 'authors', 'genres', 'description').no_cache():
+        index.add_book(book)
+    index.version = version
+    return index
+
+
+def _rebuild(version):
+    global catalog_index
+    try:
+        catalog_index = build_index(version)
+    except Exception:
+        logger.exception("could not rebuild the search index")
+
+
+def ensure_built():
+    #the index for the current catalog search version. the first search of a worker
+    #builds it; once titles change in another worker or flask import-books, a new one
+    #is built in the background and searches use the previous one until then
+    global catalog_index, _rebuilding
+    from app.model import CatalogState
+
+    version = CatalogState.search_version()
+    index = catalog_index
+    if index.version == version:
+        return index
+    with _build_lock:
+        if catalog_index.version is None:
+            catalog_index = build_index(version)
+        elif catalog_index.version != version and (_rebuilding is None or not _rebuilding.is_alive()):
+            # the version is read before the books, so a change made while building
+            # leaves the index behind and the next search builds it again
+            _rebuilding = threading.Thread(target=_rebuild, args=(version,), name='search-index', daemon=True)
+            _rebuilding.start()
+        return catalog_index
+
+
+def index_book(book, version):
+    #called after a book is saved with the search version its bump returned. when no
+    #other change came in between, this worker's index stays current without a rebuild;
+    #a worker that has not built its index yet skips it
+    index = catalog_index
+    if index.version is not None:
+        index.add_book(book)
+        with index._lock:
+            if index.version == version - 1:
+                index.version = version
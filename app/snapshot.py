@@ -0,0 +1,340 @@
+import array
+import bisect
+import glob
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from bson import ObjectId
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SGC2'
+# header: magic, then the length of the json directory that follows it
+HEADER = struct.Struct('<4sI')
+# a builder that died leaves its lock behind; after this many seconds another worker may build
+BUILD_LOCK_TIMEOUT = 600
+# fields a catalog card needs besides the columns, and the rest of what details() shows.
+# genres are kept here too, in the book's order; the genre column is only for filtering
+CARD_KEYS = ('genres', 'pages', 'teaser', 'url', 'cover')
+DETAIL_KEYS = ('copies', 'description')
+
+
+def _data_start(directory_length):
+    #sections follow the directory from the next 8-byte boundary; their offsets are relative to it
+    start = HEADER.size + directory_length
+    return start + -start % 8
+
+
+class CatalogSnapshot:
+    #one catalog version in a read-only memory-mapped file, shared through the page cache
+    #by every worker on the host. books are in (title, _id) order, the order of the
+    #catalog pages, stored column by column:
+    #  ids          12 bytes per book
+    #  category     uint16 index into the directory's category list
+    #  genres       bitmask over the directory's genre list, `words` uint64 per book
+    #  postings     uint32 row numbers of each category's and each genre's books, in
+    #               order; the directory has the [start, count] of every list
+    #  titles, authors, cards, details
+    #               utf-8 heaps with uint32 offsets (count + 1 of them)
+    #availability is not stored; it changes on every loan and is read live from MongoDB
+
+    def __init__(self, path):
+        with open(path, 'rb') as stream:
+            self._map = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._map)
+        magic, length = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a catalog snapshot")
+        self.directory = json.loads(bytes(view[HEADER.size:HEADER.size + length]))
+        base = _data_start(length)
+        self.version = self.directory['version']
+        self.count = self.directory['count']
+        self.categories = self.directory['categories']
+        self.genres = self.directory['genres']
+        self._genre_bits = {genre: bit for bit, genre in enumerate(self.genres)}
+        self._words = self.directory['words']
+
+        def section(name, fmt=None):
+            offset, size = self.directory['sections'][name]
+            data = view[base + offset:base + offset + size]
+            return data.cast(fmt) if fmt else data
+
+        self._ids = section('ids')
+        self._category = section('category', 'H')
+        self._genre_masks = section('genres', 'Q')
+        self._postings = section('postings', 'I')
+        self._heaps = {name: (section(f"{name}_offsets", 'I'), section(name))
+                       for name in ('titles', 'authors', 'cards', 'details')}
+
+    def __len__(self):
+        return self.count
+
+    def _text(self, heap, index):
+        offsets, data = self._heaps[heap]
+        return bytes(data[offsets[index]:offsets[index + 1]]).decode()
+
+    def title(self, index):
+        return self._text('titles', index)
+
+    def book_id(self, index):
+        return ObjectId(bytes(self._ids[index * 12:(index + 1) * 12]))
+
+    def _key(self, index):
+        return self.title(index), bytes(self._ids[index * 12:(index + 1) * 12])
+
+    def _bisect(self, key):
+        #first index whose (title, id) is not below key
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(self, title):
+        #index of the book with this title, or None
+        index = self._bisect((title, b''))
+        return index if index < self.count and self.title(index) == title else None
+
+    def _posting(self, kind, code):
+        #the rows of one category or genre, in (title, id) order
+        start, count = self.directory['postings'][kind][code]
+        return self._postings[start:start + count]
+
+    def scan(self, category="All", genres=(), position=None, backwards=False, limit=None):
+        #indexes of the books matching the filters after (or, backwards, before) a
+        #(title, id) position, nearest first; the same rows as get_books_page's query.
+        #a filtered scan walks the shortest posting list of its filters, so it costs about
+        #as much as the indexed query would, however rare the filter
+        code = None
+        lists = []
+        if category != "All":
+            if category not in self.categories:
+                return []
+            code = self.categories.index(category)
+            lists.append(self._posting('category', code))
+        required = [0] * self._words
+        for genre in genres:
+            if genre not in self._genre_bits:
+                return []
+            bit = self._genre_bits[genre]
+            required[bit // 64] |= 1 << (bit % 64)
+            lists.append(self._posting('genre', bit))
+
+        if position is None:
+            start = self.count - 1 if backwards else 0
+        else:
+            key = (position[0], position[1].binary)
+            start = self._bisect(key)
+            if backwards:
+                start -= 1
+            elif start < self.count and self._key(start) == key:
+                start += 1
+
+        if lists:
+            posting = min(lists, key=len)
+            if backwards:
+                rows = (posting[i] for i in range(bisect.bisect_right(posting, start) - 1, -1, -1))
+            else:
+                rows = (posting[i] for i in range(bisect.bisect_left(posting, start), len(posting)))
+        else:
+            rows = range(start, -1, -1) if backwards else range(start, self.count)
+
+        found = []
+        for index in rows:
+            if code is not None and self._category[index] != code:
+                continue
+            masks = self._genre_masks[index * self._words:(index + 1) * self._words]
+            if any(mask & need != need for mask, need in zip(masks, required)):
+                continue
+            found.append(index)
+            if limit and len(found) == limit:
+                break
+        return found
+
+    def son(self, index, details=False):
+        #the stored fields of one book as a raw document, without 'available'
+        authors = self._text('authors', index)
+        doc = {
+            '_id': self.book_id(index),
+            'title': self.title(index),
+            'authors': authors.split('\x1f') if authors else [],
+            'category': self.categories[self._category[index]],
+        }
+        doc.update(json.loads(self._text('cards', index)))
+        if details:
+            doc.update(json.loads(self._text('details', index)))
+        return doc
+
+    def close(self):
+        self._map.close()
+
+
+def write_snapshot(path, version, books):
+    #writes raw book documents (any order) as a snapshot file at path, atomically
+    books = sorted(books, key=lambda book: (book.get('title') or '', book['_id'].binary))
+    categories, genres = [], []
+    for book in books:
+        if book.get('category') not in categories:
+            categories.append(book.get('category'))
+        for genre in book.get('genres') or []:
+            if genre not in genres:
+                genres.append(genre)
+    words = max(1, (len(genres) + 63) // 64)
+    bits = {genre: bit for bit, genre in enumerate(genres)}
+
+    columns = {
+        'ids': b''.join(book['_id'].binary for book in books),
+        'category': array.array('H', (categories.index(book.get('category')) for book in books)),
+        'genres': array.array('Q', [0] * (len(books) * words)),
+    }
+    by_category = [[] for _ in categories]
+    by_genre = [[] for _ in genres]
+    for row, book in enumerate(books):
+        by_category[categories.index(book.get('category'))].append(row)
+        for genre in set(book.get('genres') or []):
+            columns['genres'][row * words + bits[genre] // 64] |= 1 << (bits[genre] % 64)
+            by_genre[bits[genre]].append(row)
+    columns['postings'] = array.array('I')
+    postings = {'category': [], 'genre': []}
+    for kind, lists in (('category', by_category), ('genre', by_genre)):
+        for rows in lists:
+            postings[kind].append([len(columns['postings']), len(rows)])
+            columns['postings'].extend(rows)
+    heaps = {
+        'titles': (book.get('title') or '' for book in books),
+        'authors': ('\x1f'.join(book.get('authors') or []) for book in books),
+        'cards': (json.dumps({key: book.get(key) for key in CARD_KEYS}) for book in books),
+        'details': (json.dumps({key: book.get(key) for key in DETAIL_KEYS}) for book in books),
+    }
+    for name, values in heaps.items():
+        offsets, data = array.array('I', [0]), bytearray()
+        for value in values:
+            data += value.encode()
+            offsets.append(len(data))
+        columns[f"{name}_offsets"] = offsets
+        columns[name] = bytes(data)
+
+    # sections start on 8-byte boundaries so every column can be viewed as its own type
+    blobs, sections, offset = [], {}, 0
+    for name, column in columns.items():
+        blob = column.tobytes() if isinstance(column, array.array) else column
+        sections[name] = [offset, len(blob)]
+        blobs.append(blob + b'\0' * (-len(blob) % 8))
+        offset += len(blobs[-1])
+    directory = json.dumps({'version': version, 'count': len(books), 'categories': categories,
+                            'genres': genres, 'words': words, 'postings': postings,
+                            'sections': sections}).encode()
+
+    descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(descriptor, 'wb') as stream:
+        stream.write(HEADER.pack(MAGIC, len(directory)))
+        stream.write(directory)
+        stream.write(b'\0' * (_data_start(len(directory)) - HEADER.size - len(directory)))
+        for blob in blobs:
+            stream.write(blob)
+    os.replace(temporary, path)
+
+
+class SnapshotStore:
+    #the snapshot of the current catalog version for this worker. a request that finds the
+    #catalog changed maps the new version's file if another worker already built it, or
+    #starts building it in the background; until then catalog reads go to MongoDB
+
+    def __init__(self):
+        self.enabled = False
+        self.directory = None
+        self._snapshot = None
+        self._building = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.enabled = app.config['CATALOG_SNAPSHOT']
+        self.directory = app.config['CATALOG_SNAPSHOT_DIR']
+        if self.enabled:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, version):
+        return os.path.join(self.directory, f"catalog-{version}.snap")
+
+    def current(self):
+        #the snapshot for the current content version, or None when there is none yet
+        if not self.enabled:
+            return None
+        from app.model import CatalogState
+
+        version = CatalogState.content_version()
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == version:
+            return snapshot
+        with self._lock:
+            if self._snapshot is not None and self._snapshot.version == version:
+                return self._snapshot
+            if os.path.exists(self.path(version)):
+                try:
+                    # the old map is not closed: a request may still be reading it
+                    self._snapshot = CatalogSnapshot(self.path(version))
+                    return self._snapshot
+                except ValueError:
+                    # written by an older release in another format; built again below
+                    logger.warning("replacing catalog snapshot %s", self.path(version))
+                    try:
+                        os.remove(self.path(version))
+                    except OSError:
+                        pass
+            if self._building is None or not self._building.is_alive():
+                self._building = threading.Thread(target=self._build_logged, args=(version,),
+                                                  name='catalog-snapshot', daemon=True)
+                self._building.start()
+        return None
+
+    def _build_logged(self, version):
+        try:
+            self.build(version)
+        except Exception:
+            logger.exception("could not build catalog snapshot %s", version)
+
+    def build(self, version=None):
+        #writes the snapshot file for a content version (the current one by default) unless
+        #it exists. returns its path, or None when another worker is writing it
+        from app.model import Book, CatalogState
+
+        version = CatalogState.content_version() if version is None else version
+        path = self.path(version)
+        lock = path + '.lock'
+        if os.path.exists(path):
+            return path
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            if time.time() - os.path.getmtime(lock) < BUILD_LOCK_TIMEOUT:
+                return None
+            os.utime(lock)
+        try:
+            fields = ('title', 'authors', 'category') + CARD_KEYS + DETAIL_KEYS
+            write_snapshot(path, version, Book.objects.only(*fields).as_pymongo().no_cache())
+        finally:
+            os.remove(lock)
+        self._remove_older(version)
+        return path
+
+    def _remove_older(self, version):
+        #workers that still map an older file keep reading it; on Windows the remove fails
+        #until they let go, and the next build tries again
+        for path in glob.glob(os.path.join(self.directory, 'catalog-*.snap')):
+            try:
+                if int(os.path.basename(path)[len('catalog-'):-len('.snap')]) < version:
+                    os.remove(path)
+            except (ValueError, OSError):
+                pass
+
+
+store = SnapshotStore()
@@ -0,0 +1,48 @@
+import mongoengine
+import pytest
+from flask_login import login_user
+from mongoengine.base import _document_registry
+from app import create_app
+
+mongomock = pytest.importorskip('mongomock')
+
+
+@pytest.fixture
+def config(tmp_path):
+    #create_app settings for an app on a fresh in-memory database; override this
+    #fixture in a module to change them
+    return {
+        'TESTING': True,
+        'WARM_UP_CONNECTIONS': False,
+        'COVER_DIR': str(tmp_path / 'covers'),
+        'MONGODB_SETTINGS': {'host': 'mongodb://localhost', 'db': 'library_test',
+                             'mongo_client_class': mongomock.MongoClient},
+    }
+
+
+@pytest.fixture
+def app(config):
+    app = create_app(config)
+    with app.app_context():
+        yield app
+    mongoengine.disconnect()
+    # documents keep the collection of the client they first used
+    for document in _document_registry.values():
+        document._collection = None
+
+
+@pytest.fixture
+def get(app):
+    #runs one GET from the loopback address through the app, as user when given. the test
+    #client needs werkzeug.__version__, which Werkzeug 3.1 no longer has, so the request is
+    #dispatched directly
+    def get(path, user=None, headers=None):
+        with app.test_request_context(path, headers=headers, environ_base={'REMOTE_ADDR': '127.0.0.1'}):
+            if user is not None:
+                login_user(user)
+            response = app.full_dispatch_request()
+            response.direct_passthrough = False
+            response.get_data()
+        return response
+
+    return get
@@ -0,0 +1,34 @@
+import re
+from app.cache import page_cache
+from app.model import Book, User
+
+
+def test_details_of_an_unknown_title_is_404(get):
+    assert get("/details/No such title").status_code == 404
+
+
+def test_cached_pages_get_fresh_form_keys_and_tokens(app, get):
+    Book(title="Harbour Lights", authors=["Tester"], category="Adult", copies=2, available=2).save()
+    member = User.create_user("Reader", "reader@lib.sg", "x")
+    page_cache.clear()
+
+    forms = []
+    for _ in range(2):
+        response = get("/details/Harbour Lights", user=member)
+        assert response.status_code == 200
+        # a browser must not keep a page whose keys may already have been used
+        assert response.cache_control.no_store
+        assert response.get_etag() == (None, None)
+        body = response.get_data(as_text=True)
+        forms.append((re.search(r'name="csrf_token" value="([^"]+)"', body).group(1),
+                      re.search(r'name="idempotency_key" value="([0-9a-f]{32})"', body).group(1)))
+    assert page_cache.stats()['hits'] >= 1
+    assert forms[0][1] != forms[1][1]
+    assert 'form-slot' not in ''.join(forms[0] + forms[1])
+
+
+def test_anonymous_pages_are_revalidated(app, get):
+    Book(title="Harbour Lights", authors=["Tester"], category="Adult", copies=2, available=2).save()
+    etag, _ = get("/details/Harbour Lights").get_etag()
+    with app.test_request_context("/details/Harbour Lights", headers={'If-None-Match': f'"{etag}"'}):
+        assert app.full_dispatch_request().status_code == 304
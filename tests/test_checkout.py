@@ -0,0 +1,59 @@
+import os
+import random
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import mongoengine
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+from app import bench, create_app
+from app.model import Book, Loan, User
+
+# the checkout race needs a real mongod; mongomock serializes every operation
+MONGODB_URI = os.environ.get('MONGODB_TEST_URI', 'mongodb://localhost:27017')
+
+
+@pytest.fixture
+def live_app():
+    try:
+        MongoClient(MONGODB_URI, serverSelectionTimeoutMS=500).admin.command('ping')
+    except PyMongoError:
+        pytest.skip(f"no mongod at {MONGODB_URI}")
+    app = create_app({'TESTING': True, 'WARM_UP_CONNECTIONS': False, 'MONGODB_URI': MONGODB_URI})
+    name = f"sg_library_checkout_{uuid.uuid4().hex[:8]}"
+    with app.app_context():
+        bench.use_database(name, app.config)
+        bench.reset()
+        yield app
+        mongoengine.get_connection().drop_database(name)
+    mongoengine.disconnect()
+    for document in bench.COLLECTIONS:
+        document._collection = None
+
+
+def test_concurrent_checkouts_never_oversell(live_app):
+    copies, workers, rounds = 3, 16, 25
+    book = Book(title="Stress test", authors=["Stress"], category="Adult", copies=copies, available=copies)
+    book.save()
+    members = [User.create_user(f"stress-{i}", f"stress-{i}@lib.sg", "x") for i in range(workers)]
+
+    def run(member):
+        rng = random.Random(member.name)
+        loaned, lowest = 0, copies
+        for _ in range(rounds):
+            copy = Book(id=book.id, copies=copies)
+            loan = Loan.create_loan(member, copy)
+            if loan:
+                loaned += 1
+                lowest = min(lowest, copy.available)
+                if rng.random() < 0.5:
+                    loan.return_loan()
+        return loaned, lowest
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(run, members))
+
+    book.reload()
+    assert min(lowest for _, lowest in results) >= 0
+    assert Loan.objects(book=book).count() == sum(loaned for loaned, _ in results)
+    assert book.available == copies - Loan.objects(book=book, returned=False).count()
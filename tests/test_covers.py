@@ -0,0 +1,178 @@
+import functools
+import http.server
+import io
+import os
+import struct
+import threading
+import zlib
+import pytest
+from werkzeug.exceptions import NotFound
+from app import covers
+from app.model import Book, CatalogState
+
+
+def png(width=2, height=3):
+    #a small valid PNG, built without Pillow
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    rows = b''.join(b'\x00' + b'\x80\x40\x20' * width for _ in range(height))
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+
+def jpeg(width, height):
+    Image = pytest.importorskip('PIL.Image')
+    out = io.BytesIO()
+    Image.new('RGB', (width, height), (200, 120, 40)).save(out, 'JPEG')
+    return out.getvalue()
+
+
+class OriginHandler(http.server.SimpleHTTPRequestHandler):
+    #serves the files in its directory; /redirect?<url> answers with a redirect to url
+
+    def do_GET(self):
+        if self.path.startswith('/redirect?'):
+            self.send_response(302)
+            self.send_header('Location', self.path[len('/redirect?'):])
+            self.end_headers()
+            return
+        super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def origin(tmp_path):
+    #a local http server standing in for the site the covers come from: (directory, base url)
+    root = tmp_path / 'origin'
+    root.mkdir()
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(OriginHandler, directory=str(root)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield root, f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def config(config):
+    # the origin above listens on the loopback address
+    config['COVER_FETCH_PRIVATE_HOSTS'] = True
+    return config
+
+
+def add_book(url):
+    book = Book(title=f"Cover test {os.urandom(4).hex()}", authors=["Tester"], category="Adult",
+                copies=1, available=1, url=url)
+    book.save()
+    return book
+
+
+def test_fetch_stores_the_original_and_every_size(app, origin):
+    root, base_url = origin
+    (root / 'cover.jpg').write_bytes(jpeg(800, 1200))
+    book = add_book(f"{base_url}/cover.jpg")
+
+    digest = covers.store.fetch(book.id, book.url)
+
+    book.reload()
+    assert book.cover == digest
+    assert book.cover_source == book.url
+    from PIL import Image
+    with Image.open(covers.store.path(digest, 'original')) as original:
+        assert original.size == (800, 1200)
+    for size, width in covers.COVER_SIZES.items():
+        with Image.open(covers.store.path(digest, size)) as resized:
+            assert resized.format == 'JPEG'
+            assert resized.size == (width, width * 3 // 2)
+
+
+def test_a_batch_of_covers_bumps_the_catalog_once(app, origin):
+    root, base_url = origin
+    (root / 'cover.png').write_bytes(png())
+    books = [add_book(f"{base_url}/cover.png") for _ in range(3)] + [add_book(f"{base_url}/missing.png")]
+    version = CatalogState.content_version()
+
+    fetched, failed = covers.wait_for(covers.store.schedule(books))
+
+    assert (fetched, failed) == (3, 1)
+    assert CatalogState.content_version() == version + 1
+    # nothing left to fetch, nothing to bump
+    covers.wait_for(covers.store.schedule(Book.objects(url=f"{base_url}/cover.png")))
+    assert CatalogState.content_version() == version + 1
+
+
+def test_serve_cover_headers(app, get, origin):
+    root, base_url = origin
+    (root / 'cover.jpg').write_bytes(jpeg(400, 600))
+    book = add_book(f"{base_url}/cover.jpg")
+    digest = covers.store.fetch(book.id, book.url)
+
+    # a versioned url never changes, so it may be cached for good
+    response = get(f"/covers/{book.id}/thumb?v={digest}")
+    assert response.status_code == 200
+    assert response.mimetype == 'image/jpeg'
+    assert response.cache_control.public
+    assert response.cache_control.immutable
+    assert response.cache_control.max_age == covers.COVER_MAX_AGE
+
+    # without ?v= the book is looked up and the answer may change
+    response = get(f"/covers/{book.id}/card")
+    assert response.status_code == 200
+    assert not response.cache_control.immutable
+    assert response.cache_control.max_age == 3600
+
+    with app.test_request_context(f"/covers/{book.id}/huge?v={digest}"):
+        with pytest.raises(NotFound):
+            covers.serve_cover(str(book.id), 'huge')
+
+
+def test_book_without_a_cover_redirects_to_its_url(app, get):
+    book = add_book("https://covers.example.org/cover.jpg")
+    response = get(f"/covers/{book.id}/card")
+    assert response.status_code == 302
+    assert response.location == book.url
+
+
+def test_without_pillow_every_size_serves_the_original(app, get, origin, monkeypatch):
+    monkeypatch.setattr(covers, 'Image', None)
+    root, base_url = origin
+    (root / 'cover.png').write_bytes(png())
+    book = add_book(f"{base_url}/cover.png")
+
+    digest = covers.store.fetch(book.id, book.url)
+
+    assert os.path.exists(covers.store.path(digest, 'original'))
+    for size in covers.COVER_SIZES:
+        assert not os.path.exists(covers.store.path(digest, size))
+        response = get(f"/covers/{book.id}/{size}?v={digest}")
+        assert response.status_code == 200
+        assert response.mimetype == 'image/png'
+        assert response.get_data() == png()
+
+
+@pytest.mark.parametrize('url', ['file:///etc/hostname', 'ftp://127.0.0.1/cover.jpg', 'data:image/png;base64,AA=='])
+def test_only_http_urls_are_fetched(app, url):
+    book = add_book(url)
+    with pytest.raises(ValueError):
+        covers.store.fetch(book.id, url)
+    assert book.reload().cover is None
+
+
+def test_redirects_to_other_schemes_are_not_followed(app, origin):
+    # urllib itself follows redirects to ftp:
+    _, base_url = origin
+    book = add_book(f"{base_url}/redirect?ftp://127.0.0.1/cover.jpg")
+    with pytest.raises(ValueError):
+        covers.store.fetch(book.id, book.url)
+    assert book.reload().cover is None
+
+
+def test_private_hosts_are_refused_by_default(app, origin, monkeypatch):
+    monkeypatch.setattr(covers.store, 'allow_private', False)
+    root, base_url = origin
+    (root / 'cover.png').write_bytes(png())
+    book = add_book(f"{base_url}/cover.png")
+    with pytest.raises(ValueError, match='not a public address'):
+        covers.store.fetch(book.id, book.url)
@@ -0,0 +1,11 @@
+from app import importer
+
+
+def test_rejected_rows_are_counted_but_only_the_first_are_kept():
+    rows = ((line_no, {'title': f"Bad {line_no}", 'copies': 'many'}) for line_no in range(1, 1001))
+
+    stats = importer.import_books(rows)
+
+    assert stats['read'] == stats['rejected'] == 1000
+    assert stats['rejects'] == [(line_no, "copies is not a number")
+                                for line_no in range(1, importer.MAX_REPORTED_REJECTS + 1)]
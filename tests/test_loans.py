@@ -0,0 +1,33 @@
+from datetime import datetime, timedelta
+from app import model
+from app.model import Book, Loan, MemberStats, User, check_indexes
+
+
+def test_ensure_indexes_fills_in_the_status_of_old_loans(app, monkeypatch):
+    # the in-memory database can neither bulk write with this pymongo nor explain queries
+    monkeypatch.setattr(Book, 'fill_teasers', lambda: 0)
+    monkeypatch.setattr(model, 'indexed_queries', lambda: [])
+    recounts = []
+    monkeypatch.setattr(MemberStats, 'refresh_open', lambda: recounts.append(True))
+    member = User(name="Old member", email="old@lib.sg", password_hash="x")
+    member.save()
+    books = [Book(title=f"Old loan {number}", authors=["Tester"], category="Adult", copies=1, available=0)
+             for number in range(3)]
+    for book in books:
+        book.save()
+    now = datetime.now()
+    loans = Loan._get_collection()
+    # loans as they were saved before the status and returned fields existed
+    returned, open_loan, late = (loans.insert_one({
+        'member': member.id, 'book': book.id, 'borrow_date': borrowed, 'due_date': borrowed + timedelta(days=14),
+        'renew_count': 0, **extra,
+    }).inserted_id for book, borrowed, extra in zip(books, (
+        now - timedelta(days=40), now - timedelta(days=5), now - timedelta(days=20),
+    ), ({'return_date': now - timedelta(days=30)}, {}, {})))
+
+    check_indexes()
+
+    statuses = {loan['_id']: (loan['status'], loan['returned']) for loan in loans.find()}
+    assert statuses == {returned: ('returned', True), open_loan: ('active', False), late: ('overdue', False)}
+    assert recounts
+    assert Loan.objects.get(id=open_loan).renew_loan()
@@ -0,0 +1,55 @@
+import types
+from app import aio, metrics
+
+
+def test_async_commands_are_charged_to_the_request(app, get, monkeypatch):
+    #the async client runs its commands on the loop thread; stand in for it with a
+    #coroutine publishing command events there, as pymongo's async client does
+    async def three_finds(database):
+        monitor = metrics.command_monitor
+        for request_id in range(3):
+            monitor.started(types.SimpleNamespace(request_id=request_id, command_name='find',
+                                                  command={'find': 'book', 'filter': {}}))
+            monitor.succeeded(types.SimpleNamespace(request_id=request_id, command_name='find',
+                                                    duration_micros=2000))
+
+    database = aio.AsyncDatabase()
+    monkeypatch.setattr(database, '_settings', ('library_test', 'localhost', None, {}))
+    monkeypatch.setattr(aio, 'AsyncMongoClient', lambda *args, **kwargs: {'library_test': None})
+
+    async def view():
+        await database.run(three_finds)
+        return 'ok'
+
+    app.add_url_rule('/three-finds', 'three_finds', view)
+    for _ in range(2):
+        response = get('/three-finds')
+        assert 'desc="3 mongo commands"' in response.headers['Server-Timing']
+
+
+def test_render_types_every_family_and_escapes_labels():
+    registry = metrics.Metrics()
+    registry.inc('library_http_requests_total', [('endpoint', 'a"b\\c\nd')])
+    registry.observe('library_http_request_seconds', [('endpoint', 'home')], 0.25)
+    registry.observe('library_http_request_seconds', [('endpoint', 'home')], 0.5)
+
+    text = registry.render([(('library_page_cache_size', ()), 3)])
+
+    assert text.splitlines() == [
+        '# TYPE library_http_request_seconds summary',
+        'library_http_request_seconds_count{endpoint="home"} 2.0',
+        'library_http_request_seconds_sum{endpoint="home"} 0.75',
+        '# TYPE library_http_requests_total counter',
+        'library_http_requests_total{endpoint="a\\"b\\\\c\\nd"} 1.0',
+        '# TYPE library_page_cache_size gauge',
+        'library_page_cache_size 3',
+    ]
+
+
+def test_metrics_are_only_served_to_allowed_scrapers(app, get):
+    assert get('/metrics').status_code == 200
+    app.config['METRICS_ALLOWED_IPS'] = '10.0.0.0/8'
+    assert get('/metrics').status_code == 403
+    app.config['METRICS_TOKEN'] = 'scrape-secret'
+    assert get('/metrics', headers={'Authorization': 'Bearer scrape-secret'}).status_code == 200
+    assert get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 403
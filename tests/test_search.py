@@ -0,0 +1,52 @@
+import pytest
+from app import search
+from app.model import Book, CatalogState
+
+
+@pytest.fixture(autouse=True)
+def catalog_index(monkeypatch):
+    #each test starts with an index that is not built yet
+    monkeypatch.setattr(search, 'catalog_index', search.SearchIndex())
+
+
+def add_book(title, **fields):
+    book = Book(title=title, authors=["Tester"], category="Adult", copies=1, available=1, **fields)
+    book.save()
+    return book
+
+
+def test_covers_and_availability_leave_the_index_alone(app, monkeypatch):
+    add_book("Harbour Lights", description=["A lighthouse keeper's year."])
+    index = search.ensure_built()
+    monkeypatch.setattr(search, 'build_index', None)
+
+    CatalogState.bump()
+    CatalogState.bump(content=False)
+
+    assert search.ensure_built() is index
+    assert [book_id for book_id, _ in index.search("lighthouse")]
+
+
+def test_a_title_added_in_this_worker_needs_no_rebuild(app, monkeypatch):
+    add_book("Harbour Lights")
+    index = search.ensure_built()
+    monkeypatch.setattr(search, 'build_index', None)
+
+    book = add_book("Winter Orchard")
+    search.index_book(book, CatalogState.bump(search=True))
+
+    assert search.ensure_built() is index
+    assert [book_id for book_id, _ in index.search("orchard")] == [book.id]
+
+
+def test_a_title_added_elsewhere_is_picked_up(app):
+    add_book("Harbour Lights")
+    index = search.ensure_built()
+
+    add_book("Winter Orchard")
+    CatalogState.bump(search=True)
+    search.ensure_built()
+    search._rebuilding.join()
+
+    assert search.catalog_index is not index
+    assert search.catalog_index.search("orchard")